@@ -0,0 +1,78 @@
+import json
+import logging
+import time
+
+import zmq
+
+from beholder.defaults import *
+
+
+class ControlServer:
+    """Remote control of a Beholder over a ZMQ REP socket, and periodic status on a PUB socket.
+
+    Requests are JSON objects with a `cmd` field, replies JSON objects with `ok` and the current `status`:
+
+        {"cmd": "status"}
+        {"cmd": "record", "state": true}    state optional, toggles without
+        {"cmd": "trial", "state": false}    starting a trial starts recording, if FORCE_RECORDING_ON_TRIAL
+        {"cmd": "note", "text": "..."}
+        {"cmd": "quit"}
+
+    Not a thread, the Beholder polls it from its loop, so commands run just like key presses.
+    """
+
+    def __init__(self, beholder, ctx, control_port=CONTROL_PORT, status_port=STATUS_PORT):
+        self.beholder = beholder
+
+        self.socket = ctx.socket(zmq.REP)
+        self.socket.bind('tcp://*:{}'.format(control_port))
+
+        self.status_socket = ctx.socket(zmq.PUB)
+        self.status_socket.bind('tcp://*:{}'.format(status_port))
+        self._t_status = 0
+
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+
+        logging.info('Control on port {}, status on port {}'.format(control_port, status_port))
+
+    def poll(self, timeout=0):
+        """Handle pending requests, waiting up to `timeout` ms for one, and publish the status when due.
+        """
+        if self.poller.poll(timeout):
+            try:
+                request = json.loads(self.socket.recv())
+                reply = self.handle(request)
+            except (ValueError, TypeError, KeyError) as e:
+                reply = {'ok': False, 'error': str(e)}
+            reply['status'] = self.beholder.status()
+            self.socket.send_json(reply)
+
+        if time.monotonic() - self._t_status > STATUS_INTERVAL:
+            self.status_socket.send_multipart([STATUS_TOPIC, json.dumps(self.beholder.status()).encode()])
+            self._t_status = time.monotonic()
+
+    def handle(self, request):
+        cmd = request['cmd']
+        logging.debug('Control command {}'.format(request))
+
+        # Requests for the current state are ignored instead of toggling
+        state = request.get('state')
+        if cmd == 'record':
+            if state is None or bool(state) != self.beholder.ev_recording.is_set():
+                self.beholder.toggle_recording(state)
+        elif cmd == 'trial':
+            if state is None or bool(state) != self.beholder.ev_trial_active.is_set():
+                self.beholder.trial_event(state)
+        elif cmd == 'note':
+            self.beholder.add_note(request.get('text'))
+        elif cmd == 'quit':
+            self.beholder.stop()
+        elif cmd != 'status':
+            raise ValueError('Unknown command {}'.format(cmd))
+
+        return {'ok': True}
+
+    def close(self):
+        self.socket.close(linger=0)
+        self.status_socket.close(linger=0)
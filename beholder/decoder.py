@@ -0,0 +1,129 @@
+import logging
+import multiprocessing as mp
+import os
+import signal
+import time
+from collections import defaultdict
+from functools import partial
+
+import cv2
+import numpy as np
+
+from beholder.defaults import *
+from beholder.util import PREVIEW_IMREAD_FLAGS
+
+# Worker process state, set up once by the pool initializer
+_cfg = None
+_mosaic = None
+
+
+def _init_worker(cfg, mosaic):
+    """Attach a decode worker process to the shared mosaic.
+    """
+    global _cfg, _mosaic
+    # Leave handling of ctrl+c to the Beholder, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _cfg = cfg
+    _mosaic = mosaic
+
+
+def _decode_tile(idx, encoded_frame, transpose, frame_index, timestamp):
+    """Decode, flip and crop an encoded frame straight into its tile of the shared mosaic.
+    """
+    t0 = cv2.getTickCount()
+    frame = cv2.imdecode(np.frombuffer(encoded_frame, dtype='uint8'), PREVIEW_IMREAD_FLAGS[_cfg['preview_scale']])
+
+    if frame is not None:
+        if transpose:
+            frame = cv2.flip(frame, -1)
+
+        try:
+            _mosaic.update(idx, frame, frame_index, timestamp)
+        except ValueError:
+            frame = None
+
+    elapsed = (cv2.getTickCount() - t0) / cv2.getTickFrequency() * 1000
+    return os.getpid(), frame is not None, elapsed
+
+
+class DecodePool:
+    """Pool of worker processes decoding frames of all sources into the shared mosaic.
+
+    Only one frame per source is in flight at any time. Frames arriving while the previous frame of the same source
+    is still being decoded are not displayed, but still recorded by the Writers.
+    """
+
+    def __init__(self, cfg, mosaic, n_workers):
+        self.n_workers = n_workers
+        self._pool = mp.Pool(n_workers, initializer=_init_worker, initargs=(cfg, mosaic))
+
+        n_sources = len(cfg['sources'])
+        self._in_flight = [False] * n_sources
+        self.n_skipped = [0] * n_sources
+
+        # Per worker decode statistics, only touched by the pool's result handler thread
+        self._worker_frames = defaultdict(int)
+        self._worker_ms = defaultdict(float)
+        self._t_report = time.time()
+        self.throughput = {}
+
+        logging.debug('Decode pool with {} workers started'.format(n_workers))
+
+    def submit(self, idx, encoded_frame, transpose=False, callback=None, frame_index=-1, timestamp=np.nan):
+        """Queue an encoded frame for decoding into the tile of source `idx`.
+
+        Returns False if the frame was skipped because the previous frame of that source is still being decoded.
+        Otherwise the frame buffer was copied to be sent to a worker.
+        """
+        if self._in_flight[idx]:
+            self.n_skipped[idx] += 1
+            return False
+
+        self._in_flight[idx] = True
+        self._pool.apply_async(_decode_tile, (idx, bytes(encoded_frame), transpose, frame_index, timestamp),
+                               callback=partial(self._decoded, idx, callback),
+                               error_callback=partial(self._failed, idx, callback))
+        return True
+
+    def busy(self, idx):
+        """Whether a frame of source `idx` is being decoded, i.e. its tile is being written by a worker.
+        """
+        return self._in_flight[idx]
+
+    def _decoded(self, idx, callback, result):
+        pid, ok, elapsed = result
+        self._in_flight[idx] = False
+        self._worker_frames[pid] += 1
+        self._worker_ms[pid] += elapsed
+
+        if callback is not None:
+            callback(ok, elapsed)
+
+        if time.time() - self._t_report > DECODE_REPORT_INTERVAL:
+            self.report()
+
+    def _failed(self, idx, callback, e):
+        self._in_flight[idx] = False
+        logging.error('Decode worker failed on frame of source {}: {}'.format(idx, e))
+        if callback is not None:
+            callback(False, None)
+
+    def report(self):
+        """Log decode throughput of each worker since the last report.
+        """
+        now = time.time()
+        dt = now - self._t_report
+        self.throughput = {pid: n / dt for pid, n in self._worker_frames.items()}
+
+        stats = ', '.join('{}: {:.1f} fps ({:.1f} ms)'.format(pid, self.throughput[pid], self._worker_ms[pid] / n)
+                          for pid, n in sorted(self._worker_frames.items()))
+        logging.info('Decode throughput {}'.format(stats))
+
+        self._worker_frames.clear()
+        self._worker_ms.clear()
+        self._t_report = now
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+        logging.debug('Decode pool terminated')
@@ -14,6 +14,7 @@ DISK_LOW_GB = 30
 # name (or path) of the ffmpeg executable. Used to differentiate system
 # installed ffmpeg from our hardware enabled/customized variant
 FFMPEG_BINARY = 'ffmpeg_gpu'
+FFMPEG_SYSTEM_BINARY = 'ffmpeg'
 # FFMPEG_COMMAND = [FFMPEG_BINARY,
 #                   '-y',
 #                   '-hide_banner',
@@ -55,7 +56,155 @@ FFMPEG_COMMAND = [FFMPEG_BINARY,
                   '-movflags', 'faststart',
                   ]
 
+# Stream copy of the JPEG frames from the eyes into a Matroska container. Needs neither GPU nor our custom ffmpeg
+# build and next to no CPU, at the cost of much larger files.
+FFMPEG_COPY_COMMAND = [FFMPEG_SYSTEM_BINARY,
+                       '-y',
+                       '-hide_banner',
+                       '-loglevel', 'error',
+                       '-nostats',
+                       '-f', 'mjpeg',
+                       '-r', '30.',
+                       '-i', '-',
+                       '-c:v', 'copy',
+                       ]
+
+# CPU encoding with libx264, the preset is filled in per encoder backend
+FFMPEG_X264_COMMAND = [FFMPEG_SYSTEM_BINARY,
+                       '-y',
+                       '-hide_banner',
+                       '-loglevel', 'error',
+                       '-nostats',
+                       '-f', 'mjpeg',
+                       '-r', '30.',
+                       '-i', '-',
+                       '-c:v', 'libx264',
+                       '-preset', '{preset}',
+                       '-crf', '23',
+                       '-pix_fmt', 'yuv420p',
+                       '-movflags', 'faststart',
+                       ]
+X264_PRESETS = ['medium', 'fast', 'veryfast', 'ultrafast']
+
+# Encoder backend to record with. 'auto' (opt-in, --encoder auto) benchmarks the available backends at startup and
+# picks the first in ENCODER_PREFERENCE able to keep up with all sources.
+DEFAULT_ENCODER = 'nvenc'
+ENCODER_PREFERENCE = ['nvenc'] + ['x264_' + preset for preset in X264_PRESETS] + ['copy', 'raw']
+ENCODER_PROBE_FRAMES = 90
+ENCODER_PROBE_MARGIN = 1.25  # required headroom over frame_fps * number of sources
+ENCODER_PROBE_STARTUP = 1.  # seconds allowed for encoder process startup during the benchmark
+
 SOCKET_RECV_TIMEOUT = 1000
+COPY_REPORT_INTERVAL = 10  # seconds between reports of frame data copied by the Grabbers
 WRITE_QUEUE_LENGTH = 150  # frames
+WRITE_BATCH_SIZE = 8  # frames per write to the encoder
+WRITE_OVERFLOW_POLICY = 'drop_newest'  # drop_newest, drop_oldest or block
+WRITE_BLOCK_TIMEOUT = 1.  # seconds a Grabber waits for room in the write queue with the block policy
+DROP_LOG_INTERVAL = 5  # seconds
 
 FORCE_RECORDING_ON_TRIAL = True
+
+# Number of decode worker processes. With 0, frames are decoded in the Grabber threads.
+DECODE_WORKERS = 0
+DECODE_REPORT_INTERVAL = 10  # seconds
+
+# Poll interval (ms) of Grabbers holding a frame waiting to be decoded for display
+DISPLAY_POLL_INTERVAL = 5
+
+# Display frames at 1/PREVIEW_SCALE of the camera resolution
+PREVIEW_SCALE = 1
+
+# Seconds of frames kept in memory to prepend to recordings. The byte pool of each source is sized for frames of
+# PRETRIGGER_FRAME_BYTES on average, with larger frames the buffer holds fewer seconds.
+PRETRIGGER_DURATION = 0
+PRETRIGGER_FRAME_BYTES = 120 * 1024
+
+# Frame metadata as csv (.meta) or binary records (.metab)
+METADATA_FORMAT = 'csv'
+METADATA_BATCH_SIZE = 300  # records per write of the binary metadata log
+
+# Split recordings into segments of this many seconds, 0 to record one file per session
+SEGMENT_LENGTH = 0
+MANIFEST_NAME = 'manifest.csv'
+
+# Keep an encoder process per Writer started ahead of recording. It encodes into a temporary file in WARM_DIR of
+# the output directory, which is moved into the recording directory once the encoder has finished.
+WARM_ENCODERS = False
+WARM_DIR = '.warm'
+
+# Encoders not accepting frames for this many seconds are killed and replaced by a new part of the segment. Writers
+# give up on a recording after ENCODER_MAX_RESTARTS replaced encoders.
+ENCODER_STALL_TIMEOUT = 5.
+ENCODER_WATCHDOG_INTERVAL = 1.  # seconds
+ENCODER_MAX_RESTARTS = 5
+
+# Disk monitor. Free space and write rates are sampled every DISK_MONITOR_INTERVAL seconds, the remaining recording
+# time is projected from the drop in free space over DISK_MONITOR_WINDOW samples.
+DISK_MONITOR_INTERVAL = 2.  # seconds
+DISK_MONITOR_WINDOW = 15  # samples
+DISK_REMAINING_WARN = 3600  # seconds of recording left before warning
+
+# Graceful degradation when Writers fall behind, i.e. a write queue is more than DEGRADE_QUEUE_FILL full or dropped
+# frames, for DEGRADE_SAMPLES consecutive samples. Level 1 decodes only the newest frame per displayed mosaic (as with
+# --decimate), level 2 stops decoding the preview, level 3 in addition starts new encoders at a lower bitrate. Levels
+# are lifted again one by one after RECOVER_SAMPLES samples without trouble.
+DEGRADE_QUEUE_FILL = .5
+DEGRADE_SAMPLES = 3
+RECOVER_SAMPLES = 30
+MAX_DEGRADE_LEVEL = 3
+
+# Extra arguments of encoders started at degradation level 3, override the quality options of the commands above
+FFMPEG_LOW_BITRATE_ARGS = ['-b:v', '200k']
+X264_LOW_BITRATE_ARGS = ['-crf', '30']
+
+# Spooling. Finished segments are moved from the spool to the output directory in chunks of MOVER_CHUNK_SIZE bytes
+# at no more than MOVER_MAX_RATE bytes per second. The mover pauses while any write queue is more than
+# MOVER_YIELD_QUEUE_FILL full.
+MOVER_CHUNK_SIZE = 16 * 2 ** 20
+MOVER_MAX_RATE = 100 * 2 ** 20
+MOVER_YIELD_QUEUE_FILL = .25
+MOVER_YIELD_INTERVAL = .5  # seconds
+MOVER_VERIFY = True  # read back copies to compare checksums
+
+# Size of the pipes to the encoders (Linux only, limited by /proc/sys/fs/pipe-max-size). Holds about a second of
+# frames, the default of 64 kB less than one.
+PIPE_BUFFER_SIZE = 2 ** 20
+
+# Display refresh. The display renders when tiles were updated, at no more than DISPLAY_FPS, and at least every
+# DISPLAY_IDLE_INTERVAL seconds to update timers and handle input.
+DISPLAY_FPS = 30
+DISPLAY_IDLE_INTERVAL = .05
+LATENCY_REPORT_INTERVAL = 10  # seconds
+
+# Remote control (REP) and status (PUB) sockets, used with --headless or --control
+CONTROL_PORT = 5570
+STATUS_PORT = 5571
+STATUS_TOPIC = b'beholder'
+STATUS_INTERVAL = 1.  # seconds
+CONTROL_POLL_INTERVAL = 100  # ms, loop interval without display
+
+# Mosaic stream for remote viewers (--stream). JPEG frames MOSAIC_STREAM_WIDTH pixels wide, at no more than
+# MOSAIC_STREAM_FPS, only encoded while someone is subscribed.
+MOSAIC_STREAM_PORT = 5572
+MOSAIC_TOPIC = b'mosaic'
+MOSAIC_STREAM_WIDTH = 800
+MOSAIC_STREAM_FPS = 5
+MOSAIC_STREAM_QUALITY = 70
+MOSAIC_STREAM_POLL_INTERVAL = .1  # seconds
+
+# Buffers per tile of the shared mosaic. With 3, the display only has to retry copying a tile when a source
+# updated it twice during the copy.
+MOSAIC_BUFFERS = 3
+
+# Name of the exported mosaic in /dev/shm (--export)
+MOSAIC_SHM_NAME = 'beholder'
+
+# Update interval of the performance HUD statistics, in seconds
+HUD_INTERVAL = 1.
+
+# Pipeline metrics (--metrics udp://host:port or a file), in InfluxDB line protocol. Port 8094 is the default of
+# telegraf's socket_listener input.
+METRICS_INTERVAL = 1.  # seconds
+METRICS_UDP_PORT = 8094
+METRICS_UDP_PAYLOAD = 1400  # bytes per datagram, to stay below the MTU
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
@@ -0,0 +1,280 @@
+import logging
+import os
+import shutil
+import subprocess as sp
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from beholder.defaults import *
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+ENCODERS = {}
+
+# Linux fcntl commands, named in the fcntl module only from Python 3.10 on
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+F_GETPIPE_SZ = getattr(fcntl, 'F_GETPIPE_SZ', 1032)
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+
+def register_encoder(encoder):
+    """Add an encoder backend to the registry of available recording backends.
+    """
+    ENCODERS[encoder.name] = encoder
+    return encoder
+
+
+class Encoder:
+    """Recording backend running an external process that reads JPEG frames from stdin and writes a video file.
+    """
+
+    def __init__(self, name, suffix, command, low_bitrate_args=None):
+        self.name = name
+        self.suffix = suffix
+        self.command = command
+        self.low_bitrate_args = low_bitrate_args or []
+
+    def available(self):
+        return shutil.which(self.command[0]) is not None
+
+    def open(self, out_path, low_bitrate=False):
+        """Start encoding into `out_path`. Returns the Popen object of the encoder process.
+        """
+        cmd = self.command + (self.low_bitrate_args if low_bitrate else []) + [str(out_path)]
+        logging.debug(' '.join(cmd))
+        return sp.Popen(cmd, stdin=sp.PIPE)
+
+
+class PipeWriter:
+    """Vectored writes of frames to the stdin of an encoder, enlarging the pipe buffer where possible.
+
+    Counts the time spent in write calls, i.e. blocked on an encoder that doesn't keep up.
+    """
+
+    def __init__(self, stdin, pipe_size=PIPE_BUFFER_SIZE):
+        self.fd = stdin.fileno()
+        self.pipe_size = None
+        self.t_blocked = 0.
+        self.n_bytes = 0
+        # Buffers of the last call written in full, also if the reader went away during the call
+        self.n_complete = 0
+
+        if fcntl is not None and pipe_size:
+            try:
+                fcntl.fcntl(self.fd, F_SETPIPE_SZ, pipe_size)
+                self.pipe_size = fcntl.fcntl(self.fd, F_GETPIPE_SZ)
+            except OSError as e:
+                # Not a pipe (raw archive) or larger than allowed
+                logging.debug('Pipe buffer size not changed: {}'.format(e))
+
+    def writelines(self, buffers):
+        """Write all buffers. Raises BrokenPipeError if the reader is gone.
+        """
+        self.n_complete = 0
+        buffers = [memoryview(buffer).cast('B') for buffer in buffers]
+        t0 = time.perf_counter()
+        try:
+            while buffers:
+                n = os.writev(self.fd, buffers[:IOV_MAX])
+                self.n_bytes += n
+
+                # Drop what was written, the pipe may have taken only part of the buffers
+                while buffers and n >= len(buffers[0]):
+                    n -= len(buffers.pop(0))
+                    self.n_complete += 1
+                if n:
+                    buffers[0] = buffers[0][n:]
+        finally:
+            self.t_blocked += time.perf_counter() - t0
+
+
+class FileSink:
+    """Stand-in for an encoder process that writes the frames it receives on stdin straight to a file.
+    """
+
+    def __init__(self, out_path):
+        self.args = [str(out_path)]
+        self.stdin = open(out_path, 'wb')
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self.stdin.closed:
+            self.stdin.close()
+        self.returncode = 0
+        return self.returncode
+
+    def kill(self):
+        self.wait()
+
+
+class RawArchive(Encoder):
+    """Concatenated JPEG frames as received, without any external process. Readable by ffmpeg with `-f mjpeg`.
+    """
+
+    def __init__(self, name='raw', suffix='.mjpeg'):
+        super().__init__(name, suffix, command=None)
+
+    def available(self):
+        return True
+
+    def open(self, out_path, low_bitrate=False):
+        return FileSink(out_path)
+
+
+class WarmEncoder:
+    """Encoder process started ahead of time, encoding into a temporary file until it is bound to a segment.
+    """
+
+    def __init__(self, encoder, warm_path, prefix, low_bitrate=False):
+        self.encoder = encoder
+        self.low_bitrate = low_bitrate
+        self.path = warm_path / '{}_{}{}'.format(prefix, uuid.uuid4().hex[:8], encoder.suffix)
+        self.proc = encoder.open(self.path, low_bitrate)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def discard(self):
+        """Stop the unused encoder and remove whatever it wrote.
+        """
+        self.proc.kill()
+        self.proc.wait()
+        if self.path.exists():
+            self.path.unlink()
+
+
+register_encoder(Encoder('nvenc', '.mp4', FFMPEG_COMMAND, FFMPEG_LOW_BITRATE_ARGS))
+for preset in X264_PRESETS:
+    register_encoder(Encoder('x264_' + preset, '.mp4', [arg.format(preset=preset) for arg in FFMPEG_X264_COMMAND],
+                             X264_LOW_BITRATE_ARGS))
+register_encoder(Encoder('copy', '.mkv', FFMPEG_COPY_COMMAND))
+register_encoder(RawArchive())
+
+
+def synthetic_clip(width, height, n_frames):
+    """List of JPEG encoded frames of a moving gradient with some sensor noise.
+    """
+    gradient = np.add.outer(np.arange(height), np.arange(width)) * 255. / (height + width)
+    frames = []
+    for n in range(n_frames):
+        img = np.roll(gradient, n * 4, axis=1) + np.random.normal(0, 8, gradient.shape)
+        img = np.clip(img, 0, 255).astype(np.uint8)
+        frames.append(cv2.imencode('.jpg', cv2.cvtColor(img, cv2.COLOR_GRAY2BGR))[1].tobytes())
+    return frames
+
+
+def benchmark_encoder(encoder, clip, n_streams, out_dir, timeout=None):
+    """Encode the clip in `n_streams` concurrent instances of the encoder.
+
+    Returns the total throughput in frames per second, or 0 if any of the instances failed. Encoders still running
+    after `timeout` seconds are killed and count as failed, frames accepted into their pipes say nothing about the
+    frames they finished encoding.
+    """
+    procs = []
+    t0 = time.perf_counter()
+    try:
+        for n in range(n_streams):
+            procs.append(encoder.open(Path(out_dir) / 'probe_{}_{:02d}{}'.format(encoder.name, n, encoder.suffix)))
+    except OSError as e:
+        logging.debug('Encoder {} failed to start: {}'.format(encoder.name, e))
+        for proc in procs:
+            proc.kill()
+        return 0.
+
+    n_written = [0] * n_streams
+
+    def feed(n, proc):
+        try:
+            for frame in clip:
+                proc.stdin.write(frame)
+                n_written[n] += 1
+            proc.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+
+    feeders = [threading.Thread(target=feed, args=(n, proc), daemon=True) for n, proc in enumerate(procs)]
+    for feeder in feeders:
+        feeder.start()
+
+    def remaining():
+        return None if timeout is None else max(0., timeout - (time.perf_counter() - t0))
+
+    # Feed all frames before waiting for the encoders, the raw archive closes its input when waited for
+    timed_out = False
+    for feeder in feeders:
+        feeder.join(remaining())
+        if feeder.is_alive():
+            timed_out = True
+            break
+
+    failed = False
+    if not timed_out:
+        for proc in procs:
+            try:
+                failed |= proc.wait(remaining()) != 0
+            except sp.TimeoutExpired:
+                timed_out = True
+                break
+    elapsed = time.perf_counter() - t0
+
+    if timed_out:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        logging.debug('Encoder {} benchmark timed out after {:.1f}s, {} frames accepted'.format(
+            encoder.name, elapsed, sum(n_written)))
+        return 0.
+
+    # Streams that didn't take the whole clip failed, even if their encoder exited cleanly
+    failed |= any(n < len(clip) for n in n_written)
+    return 0. if failed else n_streams * len(clip) / elapsed
+
+
+def probe_encoders(cfg, n_streams):
+    """Benchmark the available encoders and return the name of the preferred one that can keep up with all sources.
+
+    Falls back on the fastest encoder if none of them is fast enough.
+    """
+    required = cfg['frame_fps'] * n_streams
+    clip = synthetic_clip(cfg['frame_width'], cfg['frame_height'], ENCODER_PROBE_FRAMES)
+
+    # An encoder fast enough finishes the clip well within this time, no need to wait for slower ones
+    timeout = ENCODER_PROBE_STARTUP + len(clip) * n_streams / (required * ENCODER_PROBE_MARGIN)
+
+    throughput = {}
+    choice = None
+    with tempfile.TemporaryDirectory(prefix='beholder_probe_') as out_dir:
+        for name in ENCODER_PREFERENCE:
+            encoder = ENCODERS[name]
+            if not encoder.available():
+                logging.debug('Encoder {} not available'.format(name))
+                continue
+
+            throughput[name] = benchmark_encoder(encoder, clip, n_streams, out_dir, timeout=timeout)
+            logging.info('Encoder {}: {:.0f} fps for {} streams, {:.0f} fps required'.format(
+                name, throughput[name], n_streams, required))
+
+            if throughput[name] >= required * ENCODER_PROBE_MARGIN:
+                choice = name
+                break
+
+    if choice is None:
+        # Among encoders that all failed or timed out, the last is the least demanding
+        choice = max(reversed(list(throughput)), key=throughput.get)
+        logging.warning('No encoder can sustain {:.0f} fps! Frames will be dropped while recording.'.format(required))
+
+    logging.info('Selected encoder {}: {:.0f} fps measured, {:.0f} fps required, {:.2f}x headroom'.format(
+        choice, throughput[choice], required, throughput[choice] / required))
+    return choice
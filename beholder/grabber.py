@@ -1,8 +1,8 @@
 import datetime as dt
 import logging
 import threading
+import time
 from collections import deque, defaultdict
-from queue import Full
 
 import cv2
 import numpy as np
@@ -10,7 +10,8 @@ import pkg_resources
 import zmq
 
 from beholder.defaults import *
-from beholder.util import buf_to_numpy
+from beholder.metrics import Histogram
+from beholder.util import PREVIEW_IMREAD_FLAGS
 
 no_signal_path = pkg_resources.resource_filename(__name__, 'resources/no_signal.png')
 NO_SIGNAL_FRAME = np.rot90(cv2.imread(no_signal_path))
@@ -18,9 +19,13 @@ NO_SIGNAL_FRAME = np.rot90(cv2.imread(no_signal_path))
 no_signal_path = pkg_resources.resource_filename(__name__, 'resources/fault.png')
 FAULTY_FRAME = np.rot90(cv2.imread(no_signal_path))
 
+# Frame index and timestamp of frames not from the source
+NO_FRAME_META = (-1, np.nan)
+
 
 class Grabber(threading.Thread):
-    def __init__(self, cfg, ctx, arr, target, out_queue, trigger_event, main_thread, idx=0, transpose=False):
+    def __init__(self, cfg, ctx, mosaic, target, out_queue, trigger_event, main_thread, idx=0, transpose=False,
+                 decoder=None):
         super().__init__()
         self.id = idx
         self.cfg = cfg
@@ -41,31 +46,50 @@ class Grabber(threading.Thread):
         self.frame = None
         self.last_frame_idx = None
 
-        self.width = cfg['frame_width']
-        self.height = cfg['frame_height']
+        # Frames are decoded at reduced size for the preview mosaic
+        self.preview_scale = cfg['preview_scale']
+        self.imread_flag = PREVIEW_IMREAD_FLAGS[self.preview_scale]
+
+        self.width = cfg['frame_width'] // self.preview_scale
+        self.height = cfg['frame_height'] // self.preview_scale
         self.colors = cfg['frame_colors']
 
         self.n_row = self.id // cfg['n_cols']
         self.n_col = self.id % cfg['n_cols']
 
-        self.crop_x = cfg['frame_crop_x']
-        self.crop_y = cfg['frame_crop_y']
-        self.crop_w = self.width - 2 * self.crop_x
-        self.crop_h = self.height - self.crop_y
+        self.crop_x = cfg['frame_crop_x'] // self.preview_scale
+        self.crop_y = cfg['frame_crop_y'] // self.preview_scale
+        self.crop_w = cfg['cropped_frame_width']
+        self.crop_h = cfg['cropped_frame_height']
 
         self.transpose = transpose
 
+        # Optional pool of decode processes, replaces decoding in this thread
+        self.decoder = decoder
+
+        # Display decimation, only the newest frame is decoded once the display has shown the previous one
+        self.display_decimation = cfg['display_decimation']
+        self._pending_frame = None
+        self._last_rendered = None
+        self.n_decode_skipped = 0
+
+        # Decoding for the preview is switched off without display and when recording can't keep up
+        self.preview_enabled = not cfg['headless']
+
+        # Bytes of encoded frames copied on their way from the socket to decoder and writer
+        self.n_bytes_copied = 0
+        self.bytes_copied_per_s = 0.
+        self._n_bytes_copied_last = 0
+        self._t_stats = time.monotonic()
+        self._t_copy_logged = self._t_stats
+
         self.fault_frame = cv2.resize(FAULTY_FRAME, (self.width, self.height))
         self.no_signal_frame = cv2.resize(NO_SIGNAL_FRAME, (self.width, self.height))
 
         self.parent = main_thread
 
-        # Attach to shared buffer
-        with arr.get_lock():
-            self._shared_arr = arr
-            logging.debug('{} shared array: {}'.format(self.name, arr))
-            self._fresh_frame = buf_to_numpy(arr, shape=self.cfg['shared_shape'])
-            logging.debug('Numpy shared buffer at {}'.format(hex(self._fresh_frame.ctypes.data)))
+        # Tiles of all sources in shared memory
+        self.mosaic = mosaic
 
         # self.__ff_view = self._fresh_frame[self.height * self.n_row:self.height * (self.n_row + 1),
         #                                    self.width * self.n_col:self.width * (self.n_col + 1), :]
@@ -73,7 +97,30 @@ class Grabber(threading.Thread):
         self._write_queue = out_queue
         self._ev_terminate = trigger_event
         self._avg_fps = cfg['frame_fps']
+        # ms between received frames, per frame whether this Grabber runs its own loop or the multiplexed Ingest does
         self._t_loop = deque(maxlen=N_FRAMES_FPS_LOG)
+        self._t_decode = deque(maxlen=N_FRAMES_FPS_LOG)
+
+        # Counted for the metrics, decoded frames by the pool's result handler thread if decoding there
+        self.n_decoded = 0
+        self.network_latency = Histogram()  # ms from callback_clock_ts on the eye to recv_clock_ts
+        self._t0 = None
+
+        self._t_last_msg = None
+        self._relay = False
+        # Failed decode reported by the decode pool, relayed by this thread
+        self._relay_fault = False
+
+        # Arrival times of the frame being relayed, waiting for display, and being decoded by the pool
+        self._t_frame = None
+        self._t_pending = None
+        self._t_decoding = None
+        # Frame index and callback_clock_ts of the frame being relayed and waiting for display
+        self._meta_frame = NO_FRAME_META
+        self._meta_pending = NO_FRAME_META
+        self._t_drop_logged = 0
+        self._n_dropped_logged = 0
+        self._frame_format_deprecation_warned = False
 
         logging.debug('Grabber initialization done!')
 
@@ -82,107 +129,193 @@ class Grabber(threading.Thread):
         if md is None:
             metadata = defaultdict(lambda: None)
         else:
-            md = np.fromstring(md, dtype=PIEYE_METADATA_DTYPE)
+            md = np.frombuffer(md, dtype=PIEYE_METADATA_DTYPE)
             metadata = dict(zip(md.dtype.names, md[0]))
             metadata['name'] = metadata['name'].decode().strip()
 
         return metadata
 
-    def run(self):
-        # Start up ZMQ connection
+    def connect(self, poller):
+        """Open the SUB socket to the frame source and register it with the poller.
+
+        Needs to be called from the thread that receives from the socket.
+        """
         # TODO: Keep attempting to connect
         self.socket = self.zmq_context.socket(zmq.SUB)
         self.socket.setsockopt(zmq.SUBSCRIBE, PIEYE_SUB_TOPIC)
         logging.debug('Connecting to {}'.format(self.target))
         self.socket.connect(self.target)
 
-        self.poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.socket, zmq.POLLIN)
+        self._t_last_msg = time.monotonic()
+
+    def poll_timeout(self):
+        """Poll timeout in ms. A pending frame waiting for the display needs to be picked up in time.
+        """
+        waiting = self._pending_frame is not None or self._relay or self._relay_fault
+        return DISPLAY_POLL_INTERVAL if waiting else SOCKET_RECV_TIMEOUT
+
+    def run(self):
+        # Start up ZMQ connection
+        self.connect(self.poller)
 
         logging.debug('Starting loop in {}!'.format(self.name))
-        t0 = cv2.getTickCount()
 
-        annotate = False
-        _frame_format_deprecation_warned = False
         # Loop while stop flag not set
         while not self._ev_terminate.is_set():
             # Poll socket for incoming messages, timeout when nothing comes in
-            messages = self.poller.poll(SOCKET_RECV_TIMEOUT)
+            messages = self.poller.poll(self.poll_timeout())
             if len(messages) > 1:
                 logging.debug(len(messages))
 
             if not len(messages):
-                # Socket receive timeout, display warning
-                if not self.timed_out:
-                    self.timed_out = True
-                    logging.info('Frame source timeout!')
-                # TODO: Fault frames as JPG, so they can be handed over to the writer directly?
-                self.frame = self.no_signal_frame
-
-            else:
-                # Source reconnected
-                if self.timed_out:
-                    logging.info('Frame source (re)connected')
-                    self.timed_out = False
-
-                for socket, N in messages:
-                    self.faulted = False
-
-                    msg = socket.recv_multipart()
-                    recv_clock_ts = dt.datetime.utcnow().timestamp()
-
-                    # Handle metadata
-                    # OLD FORMAT (single zmq message, topic:timestamp:frame
-                    if len(msg) < 3:
-                        metadata = self.get_metadata(None)
-                        encoded_frame = msg[0][13:]
-                        if not _frame_format_deprecation_warned:
-                            logging.warning('Deprecated frame format received. Update eye at {}'.format(self.target))
-                            _frame_format_deprecation_warned = True
-                        metadata['frame_index'] = int.from_bytes(msg[0][5:13], byteorder='little')
-
-                    # New format
-                    else:
-                        metadata = self.get_metadata(msg[1])
-                        encoded_frame = msg[2]
-
-                    metadata['recv_clock_ts'] = recv_clock_ts
-                    metadata['bytes'] = len(encoded_frame)
-                    frame_idx = metadata['frame_index']
-
-                    if self._write_queue is not None:
-                        try:
-                            self._write_queue.put_nowait([metadata, encoded_frame])
-                        except Full:
-                            logging.warning('Write queue full! Dropping frame {}'.format(frame_idx))
-
-                    # This for some reason is performance sensitive
-                    self.frame = cv2.imdecode(np.fromstring(encoded_frame, dtype='uint8'), cv2.IMREAD_UNCHANGED)
-
-                    # For cameras of the bottom row we fliplr/flipud them in the sensor firmware to have the time stamp
-                    # on the outside of the frame. We need to reverse that now.
-                    if self.transpose:
-                        self.frame = cv2.flip(self.frame, -1)
-
-                    # Look at current and previous frame index, check for shenanigans
-                    if None not in [frame_idx, self.last_frame_idx]:
-                        delta = frame_idx - self.last_frame_idx
-                        if delta < 0:
-                            logging.warning('Frame source restart? prev: {}, curr: {}, delta: {}'.format(
-                                self.last_frame_idx,
-                                frame_idx, delta - 1))
-                        elif delta > 1:
-                            # Initial debugging has every 10000th frame being intentionally drop to check for
-                            # reliable frame skip detection
-                            if delta == 2 and not (self.last_frame_idx + 1) % 10000:
-                                logging.debug('Intentional frame skip')
-                            else:
-                                logging.warning('Frame skip! prev: {}, curr: {}, {} frame(s) lost'.format(
-                                    self.last_frame_idx,
-                                    frame_idx, delta - 1))
-
-                    # Store current frame index
-                    self.last_frame_idx = frame_idx
+                self.check_timeout()
+
+            for socket, N in messages:
+                self.receive(socket)
 
+            self.update()
+
+        logging.debug('Stopping loop in {}!'.format(self.name))
+        self.close()
+
+    def check_timeout(self, now=None):
+        """Show the no signal frame if nothing was received from the source for SOCKET_RECV_TIMEOUT.
+        """
+        now = time.monotonic() if now is None else now
+        if (now - self._t_last_msg) * 1000 < SOCKET_RECV_TIMEOUT:
+            return
+
+        # Socket receive timeout, display warning
+        if not self.timed_out:
+            self.timed_out = True
+            logging.info('Frame source {} timeout!'.format(self.target))
+
+        # TODO: Fault frames as JPG, so they can be handed over to the writer directly?
+        self.frame = self.no_signal_frame
+        self._pending_frame = None
+        # No tiles to show it in without display
+        self._relay = self.mosaic is not None
+        self._t_frame = now
+        self._t_last_msg = now
+
+    def receive(self, socket):
+        """Receive one message from the source socket and hand it over to writer and decoder.
+        """
+        self._t_last_msg = time.monotonic()
+        t_received = self._t_last_msg
+
+        # Source reconnected
+        if self.timed_out:
+            logging.info('Frame source {} (re)connected'.format(self.target))
+            self.timed_out = False
+            self._t0 = None
+
+        if self._t0 is not None:
+            self._t_loop.appendleft((t_received - self._t0) * 1000)
+        self._t0 = t_received
+
+        self.faulted = False
+
+        # Frames reference the zmq message buffers, no copies are made on the way to decoder and writer
+        msg = socket.recv_multipart(copy=False)
+        recv_clock_ts = dt.datetime.utcnow().timestamp()
+
+        # Handle metadata
+        # OLD FORMAT (single zmq message, topic:timestamp:frame
+        if len(msg) < 3:
+            metadata = self.get_metadata(None)
+            encoded_frame = msg[0].buffer[13:]
+            if not self._frame_format_deprecation_warned:
+                logging.warning('Deprecated frame format received. Update eye at {}'.format(self.target))
+                self._frame_format_deprecation_warned = True
+            metadata['frame_index'] = int.from_bytes(msg[0].buffer[5:13], byteorder='little')
+
+        # New format
+        else:
+            metadata = self.get_metadata(msg[1].buffer)
+            encoded_frame = msg[2].buffer
+
+        metadata['recv_clock_ts'] = recv_clock_ts
+        if metadata['callback_clock_ts'] is not None:
+            self.network_latency.observe((recv_clock_ts - metadata['callback_clock_ts']) * 1000)
+        metadata['bytes'] = encoded_frame.nbytes
+        frame_idx = metadata['frame_index']
+        meta = (-1 if frame_idx is None else int(frame_idx),
+                np.nan if metadata['callback_clock_ts'] is None else float(metadata['callback_clock_ts']))
+
+        if self._write_queue is not None and not self._write_queue.put([metadata, encoded_frame]):
+            self.log_dropped(frame_idx)
+
+        if not self.preview_enabled:
+            self._pending_frame = None
+        elif self.display_decimation:
+            # Latest frame wins, a pending frame the display never asked for is not decoded
+            if self._pending_frame is not None:
+                self.n_decode_skipped += 1
+            self._pending_frame = encoded_frame
+            self._t_pending = t_received
+            self._meta_pending = meta
+        else:
+            self._t_frame = t_received
+            self._meta_frame = meta
+            self._relay = self.decode(encoded_frame)
+
+        # Look at current and previous frame index, check for shenanigans
+        if None not in [frame_idx, self.last_frame_idx]:
+            delta = frame_idx - self.last_frame_idx
+            if delta < 0:
+                logging.warning('{} frame source restart? prev: {}, curr: {}, delta: {}'.format(
+                    self.name,
+                    self.last_frame_idx,
+                    frame_idx, delta - 1))
+            elif delta > 1:
+                # Initial debugging has every 10000th frame being intentionally drop to check for
+                # reliable frame skip detection
+                if delta == 2 and not (self.last_frame_idx + 1) % 10000:
+                    logging.debug('Intentional frame skip')
+                else:
+                    logging.warning('{} frame skip! prev: {}, curr: {}, {} frame(s) lost'.format(
+                        self.name,
+                        self.last_frame_idx,
+                        frame_idx, delta - 1))
+
+        # Store current frame index
+        self.last_frame_idx = frame_idx
+        self.n_frames += 1
+
+    def log_dropped(self, frame_idx):
+        """Warn about frames dropped by the full write queue, at most once every DROP_LOG_INTERVAL seconds.
+        """
+        now = time.monotonic()
+        if now - self._t_drop_logged < DROP_LOG_INTERVAL:
+            return
+
+        n_dropped = self._write_queue.n_dropped - self._n_dropped_logged
+        logging.warning('{} write queue full! {} frame(s) dropped since last warning, now at frame {}'.format(
+            self.name, n_dropped, frame_idx))
+        self._t_drop_logged = now
+        self._n_dropped_logged = self._write_queue.n_dropped
+
+    def update(self):
+        """Decode pending frames and relay fresh frames into the shared array.
+        """
+        # Decode the newest pending frame once the display has rendered since our last decode
+        if self._pending_frame is not None and self.parent.n_rendered != self._last_rendered:
+            self._last_rendered = self.parent.n_rendered
+            self._t_frame = self._t_pending
+            self._meta_frame = self._meta_pending
+            self._relay = self.decode(self._pending_frame)
+            self._pending_frame = None
+
+        if self._relay_fault:
+            self._relay_fault = False
+            self.frame = self.fault_frame
+            self._relay = True
+
+        # Frames handed to the decode pool end up in the shared array without passing through here. The tile has a
+        # single writer, placeholder frames wait while the pool is writing a frame into it.
+        if self._relay and not (self.decoder is not None and self.decoder.busy(self.id)):
             # If no valid frame was decoded even though we did receive something, show a warning
             if self.frame is None:
                 self.faulted = True
@@ -193,14 +326,62 @@ class Grabber(threading.Thread):
 
             # Send frames to attached threads/processes
             self.relay_frames()
+            self._relay = False
 
-            self.n_frames += len(messages)
+        self.update_stats()
 
-            self._t_loop.appendleft((cv2.getTickCount() - t0) / cv2.getTickFrequency() * 1000)
-            t0 = cv2.getTickCount()
+    def decode(self, encoded_frame):
+        """Decode a frame, or hand it over to the decode pool.
 
-        logging.debug('Stopping loop in {}!'.format(self.name))
-        self.close()
+        Returns True if self.frame was updated and still needs to be relayed into the shared array.
+        """
+        if self.decoder is not None:
+            # Handing the frame to another process requires a copy
+            if self.decoder.submit(self.id, encoded_frame, self.transpose, self.on_decoded, *self._meta_frame):
+                self.n_bytes_copied += encoded_frame.nbytes
+                self._t_decoding = self._t_frame
+            return False
+
+        # This for some reason is performance sensitive
+        t0 = cv2.getTickCount()
+        self.frame = cv2.imdecode(np.frombuffer(encoded_frame, dtype='uint8'), self.imread_flag)
+
+        # For cameras of the bottom row we fliplr/flipud them in the sensor firmware to have the time
+        # stamp on the outside of the frame. We need to reverse that now.
+        if self.transpose and self.frame is not None:
+            self.frame = cv2.flip(self.frame, -1)
+        self._t_decode.appendleft((cv2.getTickCount() - t0) / cv2.getTickFrequency() * 1000)
+        if self.frame is not None:
+            self.n_decoded += 1
+        return True
+
+    def update_stats(self):
+        """Update once per second rates of the counters.
+        """
+        now = time.monotonic()
+        if now - self._t_stats < 1:
+            return
+
+        self.bytes_copied_per_s = (self.n_bytes_copied - self._n_bytes_copied_last) / (now - self._t_stats)
+        if self.bytes_copied_per_s and now - self._t_copy_logged > COPY_REPORT_INTERVAL:
+            logging.info('{} copied {:.1f} kB/s of frame data'.format(self.name, self.bytes_copied_per_s / 1000))
+            self._t_copy_logged = now
+
+        self._n_bytes_copied_last = self.n_bytes_copied
+        self._t_stats = now
+
+    def on_decoded(self, ok, elapsed):
+        """Called by the decode pool once a frame of this source was decoded into the shared array, in `elapsed` ms.
+        """
+        if elapsed is not None:
+            self._t_decode.appendleft(elapsed)
+        self.faulted = not ok
+        if ok:
+            self.n_decoded += 1
+            self.parent.scheduler.notify(self.id, self._t_decoding)
+        else:
+            # The fault frame is written into the tile by the Grabber's own thread
+            self._relay_fault = True
 
     def annotate_frame(self):
         pass
@@ -222,16 +403,14 @@ class Grabber(threading.Thread):
     def relay_frames(self):
         """Forward acquired image to entities downstream via queues or shared array.
         """
+        # Placeholder frames carry no frame index or timestamp
+        placeholder = self.frame is self.fault_frame or self.frame is self.no_signal_frame
         try:
-            fc_lim_M = (self.crop_y, self.crop_y + self.crop_h) if self.n_row else (0, self.crop_h)
-            fc_lim_N = (self.crop_x, self.crop_w + self.crop_x)
-
-            self._fresh_frame[self.crop_h * self.n_row:self.crop_h * (self.n_row + 1),
-            self.crop_w * self.n_col:self.crop_w * (self.n_col + 1), :] = \
-                self.frame[fc_lim_M[0]:fc_lim_M[1], fc_lim_N[0]:fc_lim_N[1]]
+            self.mosaic.update(self.id, self.frame, *(NO_FRAME_META if placeholder else self._meta_frame))
+            self.parent.scheduler.notify(self.id, self._t_frame)
 
         except ValueError as e:
-            logging.debug(('VE', self.n_col, self.n_row, self._fresh_frame.shape, e))
+            logging.debug(('VE', self.id, self.mosaic.shape, e))
 
     def close(self):
         pass
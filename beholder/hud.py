@@ -0,0 +1,104 @@
+import time
+
+import cv2
+
+from beholder.defaults import *
+
+FONT = cv2.FONT_HERSHEY_PLAIN
+
+
+class PerformanceHud:
+    """Pipeline statistics of each tile drawn onto the mosaic, toggled with 'h'.
+
+    Per tile: received frames per second, decode time, write queue depth, frames dropped by the write queue, and
+    latency from frame arrival to display. A global line shows the render time and rate.
+
+    Statistics are gathered once per HUD_INTERVAL from the counters and timing deques the Grabbers, write queues and
+    render scheduler keep anyway. The frame rate comes from the intervals between the last frames of a source. The
+    text is drawn into the Beholder's cached static overlay, so renders in between only composite it.
+    """
+
+    def __init__(self, beholder, enabled=False):
+        self.beholder = beholder
+        self.enabled = enabled
+
+        self.tile_lines = None
+        self.global_line = None
+        self._t_update = 0.
+        self._last = None
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self._t_update = 0.
+
+    def update(self):
+        """Gather statistics if due. Returns True if the HUD text changed and the overlay has to be redrawn.
+        """
+        if not self.enabled:
+            changed = self.tile_lines is not None
+            self.tile_lines = self.global_line = None
+            self._last = None
+            return changed
+
+        now = time.monotonic()
+        if now - self._t_update < HUD_INTERVAL:
+            return False
+
+        b = self.beholder
+        render_fps = None if self._last is None else (b.n_rendered - self._last) / (now - self._t_update)
+        self._last = b.n_rendered
+        self._t_update = now
+
+        self.tile_lines = []
+        for idx, (grabber, queue) in enumerate(zip(b.grabbers, b.write_queues)):
+            frame_interval = None if grabber.timed_out else _mean(grabber._t_loop)
+            fps = 1000 / frame_interval if frame_interval else None
+            decode_ms = _mean(grabber._t_decode)
+            latency_ms = b.scheduler.latency_ms(idx)
+            self.tile_lines.append([
+                '{} fps  decode {} ms'.format(_fmt(fps, '{:.1f}'), _fmt(decode_ms, '{:.1f}')),
+                'queue {}/{}  dropped {}'.format(len(queue), queue.capacity, queue.n_dropped),
+                'latency {} ms'.format(_fmt(latency_ms, '{:.0f}'))])
+
+        self.global_line = 'render {} ms  {} renders/s'.format(_fmt(_mean(b._loop_times), '{:.1f}'),
+                                                                _fmt(render_fps, '{:.1f}'))
+        return True
+
+    def key(self):
+        """Identifies the current text, for caching of the overlay.
+        """
+        if self.tile_lines is None:
+            return None
+        return tuple(map(tuple, self.tile_lines)), self.global_line
+
+    def draw(self, frame):
+        """Draw the HUD onto the BGRA overlay `frame`.
+        """
+        if self.tile_lines is None:
+            return
+
+        b = self.beholder
+        px = b.px
+        font_scale = .8 / b.preview_scale
+        for idx, lines in enumerate(self.tile_lines):
+            tile, _ = b.mosaic.tiles[idx]
+            for n, line in enumerate(lines):
+                _outlined_text(frame, line, (tile[1].start + px(15), tile[0].start + px(90 + 30 * n)), font_scale,
+                               px(2))
+
+        _outlined_text(frame, self.global_line, (px(100), frame.shape[0] - px(20)), font_scale, px(2))
+
+
+def _mean(values):
+    return sum(values) / len(values) if len(values) else None
+
+
+def _fmt(value, fmt):
+    return '-' if value is None else fmt.format(value)
+
+
+def _outlined_text(frame, text, org, font_scale, thickness):
+    cv2.putText(frame, text, org, fontFace=FONT, fontScale=font_scale, color=(0, 0, 0, 255),
+                thickness=thickness + 2)
+    cv2.putText(frame, text, org, fontFace=FONT, fontScale=font_scale, color=(255, 255, 255, 255),
+                thickness=thickness)
@@ -0,0 +1,47 @@
+import logging
+import threading
+import time
+
+import zmq
+
+from beholder.defaults import *
+
+
+class Ingest(threading.Thread):
+    """Single I/O thread receiving from the sockets of all Grabbers with one poller.
+
+    The Grabbers are used as per-source handlers and not started as threads of their own. Received frames are
+    dispatched to the write queues and decoders exactly as in the threaded Grabbers.
+    """
+
+    def __init__(self, grabbers, trigger_event):
+        super().__init__()
+        self.name = 'Ingest'
+        self.grabbers = grabbers
+        self.poller = zmq.Poller()
+        self._ev_terminate = trigger_event
+
+        self.n_polls = 0
+
+    def run(self):
+        for grabber in self.grabbers:
+            grabber.connect(self.poller)
+
+        logging.debug('Starting loop in {} for {} sources!'.format(self.name, len(self.grabbers)))
+
+        while not self._ev_terminate.is_set():
+            timeout = min(grabber.poll_timeout() for grabber in self.grabbers)
+            ready = dict(self.poller.poll(timeout))
+            self.n_polls += 1
+
+            now = time.monotonic()
+            for grabber in self.grabbers:
+                if grabber.socket in ready:
+                    grabber.receive(grabber.socket)
+                else:
+                    grabber.check_timeout(now)
+                grabber.update()
+
+        logging.debug('Stopping loop in {}!'.format(self.name))
+        for grabber in self.grabbers:
+            grabber.close()
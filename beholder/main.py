@@ -1,17 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
-import ctypes
 import logging
 import math
-import multiprocessing as mp
 import shutil
 import sys
 import threading
 import time
 from collections import deque
 from pathlib import Path
-from queue import Queue
 
 import cv2
 import numpy as np
@@ -19,10 +16,21 @@ import pkg_resources
 import yaml
 import zmq
 
+from beholder.control import ControlServer
+from beholder.hud import PerformanceHud
+from beholder.metrics import Metrics
+from beholder.stream import MosaicPublisher
+from beholder.decoder import DecodePool
 from beholder.defaults import *
+from beholder.encoders import ENCODERS, probe_encoders
 from beholder.grabber import Grabber
-from beholder.util import buf_to_numpy, fmt_time, euclidean_distance
-from beholder.writer import Writer
+from beholder.ingest import Ingest
+from beholder.monitor import DiskMonitor
+from beholder.mosaic import RenderScheduler, SharedMosaic
+from beholder.mover import Mover
+from beholder.ringbuffer import FrameRing, OVERFLOW_POLICIES
+from beholder.util import fmt_time, euclidean_distance, PREVIEW_IMREAD_FLAGS
+from beholder.writer import EncoderWatchdog, Writer
 
 SHARED_ARR = None
 FONT = cv2.FONT_HERSHEY_PLAIN
@@ -47,6 +55,10 @@ class Beholder:
         self.timing_trial_start = None
         self.timing_recording_start = None
 
+        # Index of the first segment of a recording on the eyes' clock, set by the Writer starting first
+        self._first_segment_key = None
+        self._segment_lock = threading.Lock()
+
         # recording target
         self.output_path = cfg['out_path']
         self.recording_path = None
@@ -54,6 +66,7 @@ class Beholder:
         self.__last_button_press = None
 
         self._loop_times = deque(maxlen=N_FRAMES_FPS_LOG)
+        self.n_rendered = 0
         self.__last_display = time.time()
 
         self.cfg = cfg
@@ -63,9 +76,12 @@ class Beholder:
         self.n_cols = math.ceil(len(self.cfg['sources']) / self.n_rows)
         self.cfg['n_cols'] = self.n_cols
 
-        self.cropped_frame_width = cfg['frame_width'] - 2 * cfg['frame_crop_x']
+        # Frames are decoded at 1/preview_scale resolution for the mosaic
+        self.preview_scale = cfg['preview_scale']
+
+        self.cropped_frame_width = (cfg['frame_width'] - 2 * cfg['frame_crop_x']) // self.preview_scale
         self.cfg['cropped_frame_width'] = self.cropped_frame_width
-        self.cropped_frame_height = cfg['frame_height'] - cfg['frame_crop_y']
+        self.cropped_frame_height = (cfg['frame_height'] - cfg['frame_crop_y']) // self.preview_scale
         self.cfg['cropped_frame_height'] = self.cropped_frame_height
 
         self.cfg['shared_shape'] = (self.cfg['cropped_frame_height'] * self.n_rows,
@@ -74,33 +90,67 @@ class Beholder:
 
         self.zmq_context = zmq.Context()
 
-        # Construct the shared array to fit all frames
-        bufsize = self.cfg['cropped_frame_width'] * self.cfg['cropped_frame_height'] * cfg['frame_colors'] * len(
-            cfg['sources'])
-
-        self._shared_arr = mp.Array(ctypes.c_ubyte, bufsize)
-        logging.debug('Beholder shared array: {}'.format(self._shared_arr))
-        self.frame = buf_to_numpy(self._shared_arr, shape=self.cfg['shared_shape'])
+        # Without display, frames are only recorded and never decoded
+        self.headless = cfg['headless']
 
-        self.disp_frame = np.zeros(self.frame.shape, dtype=np.uint8)
+        # Construct the shared mosaic to fit all frames, nothing to show without display
+        self.mosaic = None
+        self.disp_frame = None
+        if self.headless:
+            if cfg['export']:
+                logging.warning('No mosaic to export when headless')
+        else:
+            self.mosaic = SharedMosaic(self.cfg, len(self.sources), name=cfg['export'])
+            logging.debug('Beholder shared mosaic: {} x {}'.format(self.mosaic.n_buffers, self.mosaic.shape))
+            self.disp_frame = np.zeros(self.mosaic.shape, dtype=np.uint8)
+
+        # Renders are triggered by tile updates
+        self.scheduler = RenderScheduler(len(self.sources), fps=cfg['display_fps'])
+
+        # Tiles of the display frame are only copied from the mosaic when they have changed since the last render
+        self._tile_gen = np.zeros(len(self.sources), dtype=np.uint64)
+        self._tile_status = [None] * len(self.sources)
+        self._overlay_tiles = set(range(len(self.sources)))
+        self.hud = PerformanceHud(self, enabled=cfg['hud'])
+        self._static_overlay_key = None
+        self._static_overlay = None
+
+        # Decode worker processes, forked before any of our threads are started
+        self.decoder = None
+        if cfg['decode_workers'] and not self.headless:
+            self.decoder = DecodePool(self.cfg, self.mosaic, cfg['decode_workers'])
 
         self.measure_points = [None, None]
 
         # self.paused_frame = np.zeros_like(self.frame)
 
         # Frame queues for video file output
-        self.write_queues = [Queue(maxsize=WRITE_QUEUE_LENGTH) for _ in range(len(self.sources))]
+        self.write_queues = [FrameRing(WRITE_QUEUE_LENGTH, policy=cfg['write_overflow'],
+                                       block_timeout=WRITE_BLOCK_TIMEOUT) for _ in range(len(self.sources))]
 
         # Grabber objects
         self.grabbers = [Grabber(cfg=self.cfg,
                                  target=self.sources[n],
-                                 arr=self._shared_arr,
+                                 mosaic=self.mosaic,
                                  out_queue=self.write_queues[n],
                                  trigger_event=self.ev_stop,
                                  ctx=self.zmq_context,
                                  idx=n,
                                  transpose=n >= 6,
-                                 main_thread=self) for n in range(len(self.sources))]
+                                 main_thread=self,
+                                 decoder=self.decoder) for n in range(len(self.sources))]
+
+        # Threads receiving from the sources, either one per Grabber or a single multiplexing thread
+        if cfg['multiplexed_ingest']:
+            if self.decoder is None and not cfg['display_decimation']:
+                logging.warning('Multiplexed ingest decodes all frames in a single thread. Use decode workers!')
+            self.ingest_threads = [Ingest(self.grabbers, trigger_event=self.ev_stop)]
+        else:
+            self.ingest_threads = self.grabbers
+
+        # Migration of finished segments from the spool to the output directory
+        self.mover = Mover(self.write_queues) if cfg['spool_path'] is not None else None
+
         # Video storage writers
         self.writers = [Writer(cfg=cfg,
                                in_queue=self.write_queues[n],
@@ -108,40 +158,81 @@ class Beholder:
                                ev_recording=self.ev_recording,
                                ev_trial_active=self.ev_trial_active,
                                idx=n,
+                               mover=self.mover,
                                main_thread=self) for n in range(len(self.sources))]
 
+        self.watchdog = EncoderWatchdog(self.writers)
+        self.monitor = DiskMonitor(cfg, cfg['spool_path'] or self.output_path, self.writers, self.grabbers,
+                                   self.ev_stop, self.ev_recording)
+
         self.notes = []
 
-        # Start threads
-        for n in range(len(self.sources)):
-            self.grabbers[n].start()
-            self.writers[n].start()
+        self.metrics = None
+        if cfg['metrics']:
+            self.metrics = Metrics(cfg['metrics'], self.ev_stop)
+            self.register_metrics()
 
-        cv2.namedWindow('Beholder', cv2.WINDOW_AUTOSIZE)
-        cv2.setMouseCallback("Beholder", self.process_mouse)
+        # Start threads
+        for thread in self.ingest_threads:
+            thread.start()
+        if self.mover is not None:
+            self.mover.start()
+        for writer in self.writers:
+            writer.start()
+        self.watchdog.start()
+        self.monitor.start()
+        if self.metrics is not None:
+            self.metrics.start()
+
+        self.control = None
+        if self.headless or cfg['control']:
+            self.control = ControlServer(self, self.zmq_context)
+
+        self.publisher = None
+        if cfg['stream']:
+            if self.headless:
+                logging.warning('No mosaic to stream when headless')
+            else:
+                self.publisher = MosaicPublisher(self.zmq_context, self.ev_stop, width=cfg['stream_width'],
+                                                 fps=cfg['stream_fps'], quality=cfg['stream_quality'],
+                                                 http_port=cfg['stream_http'])
+                self.publisher.start()
+
+        if not self.headless:
+            cv2.namedWindow('Beholder', cv2.WINDOW_AUTOSIZE)
+            cv2.setMouseCallback("Beholder", self.process_mouse)
 
         logging.debug('Beholder initialization done!')
         self.paused = False
 
     def loop(self):
+        if self.headless:
+            self.loop_headless()
+            return
+
         try:
-            t0 = cv2.getTickCount()
             while not self.ev_stop.is_set():
-                if not all([grabber.is_alive() for grabber in self.grabbers]):
+                if not all([thread.is_alive() for thread in self.ingest_threads]):
                     self.stop()
                     break
 
-                if self.paused:
-                    pass
-                else:
-                    pass
-                    # with self._shared_arr.get_lock():
-                    #     # Copy shared frame content into display buffer
-                self.disp_frame[:] = self.frame
+                arrivals = self.scheduler.wait()
+                t0 = cv2.getTickCount()
 
-                self.annotate_frame(self.disp_frame)
+                # Copy only the tiles updated or drawn over since the last render
+                dirty = self.dirty_tiles()
+                for idx in dirty:
+                    gen = self.mosaic.read(idx, self.disp_frame)
+                    if gen is not None:
+                        self._tile_gen[idx] = gen
+
+                self.annotate_frame(self.disp_frame, dirty)
                 if not self.paused:
                     cv2.imshow('Beholder', self.disp_frame)
+                    self.n_rendered += 1
+                    self.scheduler.rendered(arrivals)
+                    if self.publisher is not None:
+                        self.publisher.submit(self.disp_frame)
 
                 elapsed = ((cv2.getTickCount() - t0) / cv2.getTickFrequency()) * 1000
                 self._loop_times.appendleft(elapsed)
@@ -149,17 +240,68 @@ class Beholder:
                     # print(elapsed)
                     self.__last_display = time.time()
 
-                t0 = cv2.getTickCount()
                 self.process_events()
 
         except KeyboardInterrupt:
             self.stop()
 
-    def annotate_frame(self, frame):
+        if self.control is not None:
+            self.control.close()
+
+    def px(self, v):
+        """Scale a size in full resolution pixels to the preview mosaic."""
+        return max(1, round(v / self.preview_scale))
+
+    def tile_status(self):
+        """Color of the recording status indicator of each tile.
+        """
+        colors = []
+        for n_cam, writer in enumerate(self.writers):
+            status_color = (80, 80, 80) if writer.is_alive() else (128, 0, 128)
+            if self.ev_recording.is_set():
+                status_color = (255, 165, 0)
+            if self.ev_recording.is_set() != writer.recording:
+                status_color = (0, 0, 255)
+            colors.append(status_color)
+        return colors
+
+    def dirty_tiles(self):
+        """Tiles with new frames, a changed status, or overlays drawn over them in the last render.
+        """
+        dirty = set(self.mosaic.changed(self._tile_gen).tolist()) | self._overlay_tiles
+
+        status = self.tile_status()
+        dirty.update(idx for idx, color in enumerate(status) if color != self._tile_status[idx])
+        self._tile_status = status
+
+        # New HUD text replaces the old one in the overlay of all tiles
+        if self.hud.update():
+            dirty.update(range(len(self.sources)))
+        return dirty
+
+    def mark_overlay(self, x0, y0, x1, y1):
+        """Note the tiles under an overlay spanning tiles, they have to be restored before the next render.
+        """
+        self._overlay_tiles.update(self.mosaic.tiles_in_rect(x0, y0, x1, y1))
+
+    def mark_text(self, text, org, font_scale, thickness):
+        (w, h), baseline = cv2.getTextSize(text, FONT, font_scale, thickness)
+        self.mark_overlay(org[0], org[1] - h - thickness, org[0] + w + thickness, org[1] + baseline + thickness)
+
+    def annotate_frame(self, frame, tiles=None):
+        """Draw the dynamic overlays, and composite the static overlay onto `tiles` (default all).
+        """
+        px = self.px
+        font_scale = 1 / self.preview_scale
+        if tiles is None:
+            tiles = range(len(self.sources))
+        self._overlay_tiles = set()
+
         # Distance measure tool
         if None not in self.measure_points:
             p1, p2 = self.measure_points
             cv2.line(frame, p1, p2, (255, 255, 0), thickness=1, lineType=cv2.LINE_AA)
+            self.mark_overlay(min(p1[0], p2[0]), min(p1[1], p2[1]), max(p1[0], p2[0]), max(p1[1], p2[1]))
 
         # big recording indicator
         if self.ev_recording.is_set():
@@ -167,45 +309,70 @@ class Beholder:
             all_recording = all([w.recording for w in self.writers])
             status_color = (25, 25, 200) if all_recording else (0, 0, 255)
 
-            w = 50
-            ofs = w // 2 + 5
+            w = px(50)
+            ofs = w // 2 + px(5)
             if int(delta) % 2 and not all_recording:
                 cv2.rectangle(frame, (ofs, ofs), (frame.shape[1]-ofs, frame.shape[0]-ofs), color=status_color, thickness=w)
+                self._overlay_tiles.update(range(len(self.sources)))
 
-            cv2.putText(frame, 'Rec: ' + fmt_time(delta)[:8], (100, 161), fontFace=FONT, fontScale=2,
-                        color=(255, 255, 255), thickness=2)
+            rec_text = 'Rec: ' + fmt_time(delta)[:8]
+            cv2.putText(frame, rec_text, (px(100), px(161)), fontFace=FONT,
+                        fontScale=2 * font_scale, color=(255, 255, 255), thickness=px(2))
+            self.mark_text(rec_text, (px(100), px(161)), 2 * font_scale, px(2))
 
-        # Recording status indicator
-        for row in range(self.n_rows):
-            for col in range(self.n_cols):
-                n_cam = col + row * self.n_cols
-                status_color = (80, 80, 80) if self.writers[n_cam].is_alive() else (128, 0, 128)
-                if self.ev_recording.is_set():
-                    status_color = (255, 165, 0)
-                if self.ev_recording.is_set() != self.writers[n_cam].recording:
-                    status_color = (0, 0, 255)
-                cx = col * self.cropped_frame_width + 30
-                if row + 1 != self.n_rows:
-                    cy = row * self.cropped_frame_height + 30
-                else:
-                    cy = self.n_rows * self.cropped_frame_height - 30  # last row
-
-                cv2.circle(frame, (cx, cy), 20, color=status_color, thickness=-1)
-
-                cv2.putText(frame, str(n_cam+1), (cx - 2 - 8 * (len(str(n_cam))), cy + 10), fontFace=FONT,
-                            fontScale=2, color=(255, 255, 255), thickness=2)
+            # Free disk space and projected remaining recording time
+            remaining = self.monitor.remaining
+            disk_warning = self.monitor.level or (remaining is not None and remaining < DISK_REMAINING_WARN)
+            disk_text = self.monitor.status()
+            cv2.putText(frame, disk_text, (px(100), px(200)), fontFace=FONT, fontScale=font_scale,
+                        color=(0, 0, 255) if disk_warning else (255, 255, 255), thickness=px(2))
+            self.mark_text(disk_text, (px(100), px(200)), font_scale, px(2))
 
         # trial duration stopwatch
         if self.ev_trial_active.is_set():
             delta = time.time() - self.timing_trial_start
             t_str = fmt_time(delta)
-            cv2.putText(frame, f'{t_str[3:5]}min{t_str[6:8]}s', (15, 320), fontFace=FONT, fontScale=4.5,
-                        color=(0, 0, 0), thickness=7)
-            cv2.putText(frame, f'{t_str[3:5]}min{t_str[6:8]}s', (15, 320), fontFace=FONT, fontScale=4.5,
-                        color=(255, 255, 255), thickness=4)
+            cv2.putText(frame, f'{t_str[3:5]}min{t_str[6:8]}s', (px(15), px(320)), fontFace=FONT,
+                        fontScale=4.5 * font_scale, color=(0, 0, 0), thickness=px(7))
+            cv2.putText(frame, f'{t_str[3:5]}min{t_str[6:8]}s', (px(15), px(320)), fontFace=FONT,
+                        fontScale=4.5 * font_scale, color=(255, 255, 255), thickness=px(4))
+            self.mark_text(f'{t_str[3:5]}min{t_str[6:8]}s', (px(15), px(320)), 4.5 * font_scale, px(7))
+
+        # Status indicators and alignment markers of the tiles, on top of everything drawn over them
+        overlay, mask = self.static_overlay()
+        for n_cam in sorted(set(tiles) | self._overlay_tiles):
+            tile, _ = self.mosaic.tiles[n_cam]
+            np.copyto(frame[tile], overlay[tile], where=mask[tile])
+
+    def static_overlay(self):
+        """Overlay of the tiles' status indicators, alignment markers and HUD with its mask.
+
+        Rendered once and cached until the status of a tile or the HUD changes.
+        """
+        key = tuple(self._tile_status), self.cfg['alignment_markers'], self.hud.key()
+        if key == self._static_overlay_key:
+            return self._static_overlay
+
+        px = self.px
+        font_scale = 1 / self.preview_scale
+        frame = np.zeros(self.mosaic.shape[:2] + (4,), dtype=np.uint8)
 
-        # Draw alignment markers
         # Recording status indicator
+        for n_cam in range(len(self.sources)):
+            row, col = divmod(n_cam, self.n_cols)
+            status_color = self._tile_status[n_cam] + (255,)
+            cx = col * self.cropped_frame_width + px(30)
+            if row + 1 != self.n_rows:
+                cy = row * self.cropped_frame_height + px(30)
+            else:
+                cy = self.n_rows * self.cropped_frame_height - px(30)  # last row
+
+            cv2.circle(frame, (cx, cy), px(20), color=status_color, thickness=-1)
+
+            cv2.putText(frame, str(n_cam+1), (cx - px(2 + 8 * (len(str(n_cam)))), cy + px(10)), fontFace=FONT,
+                        fontScale=2 * font_scale, color=(255, 255, 255, 255), thickness=px(2))
+
+        # Draw alignment markers
         if self.cfg['alignment_markers']:
             for row in range(self.n_rows):
                 for col in range(self.n_cols):
@@ -215,16 +382,22 @@ class Beholder:
                     rh = self.cropped_frame_height//num
                     rw = self.cropped_frame_width//num
                     for n in range(num):
-                        cv2.line(frame, (cx+n*rw, cy), (cx+n*rw, cy+self.cropped_frame_height), (0, 0, 255))
-                        cv2.line(frame, (cx, cy+n*rh), (cx+self.cropped_frame_width, cy+n*rh), (0, 0, 255))
+                        cv2.line(frame, (cx+n*rw, cy), (cx+n*rw, cy+self.cropped_frame_height), (0, 0, 255, 255))
+                        cv2.line(frame, (cx, cy+n*rh), (cx+self.cropped_frame_width, cy+n*rh), (0, 0, 255, 255))
+
+                    cross_size = px(50)
+                    cv2.line(frame, (cx + self.cropped_frame_width//2-cross_size//2, cy + self.cropped_frame_height//2), (cx + self.cropped_frame_width//2+cross_size//2, cy + self.cropped_frame_height//2), (0, 255, 255, 255))
+                    cv2.line(frame, (cx + self.cropped_frame_width//2, cy + self.cropped_frame_height//2-cross_size//2), (cx + self.cropped_frame_width//2, cy + self.cropped_frame_height//2+cross_size//2), (0, 255, 255, 255))
 
-                    cross_size = 50
-                    cv2.line(frame, (cx + self.cropped_frame_width//2-cross_size//2, cy + self.cropped_frame_height//2), (cx + self.cropped_frame_width//2+cross_size//2, cy + self.cropped_frame_height//2), (0, 255, 255))
-                    cv2.line(frame, (cx + self.cropped_frame_width//2, cy + self.cropped_frame_height//2-cross_size//2), (cx + self.cropped_frame_width//2, cy + self.cropped_frame_height//2+cross_size//2), (0, 255, 255))
+        self.hud.draw(frame)
+
+        self._static_overlay_key = key
+        self._static_overlay = frame[..., :3], frame[..., 3:] > 0
+        return self._static_overlay
 
     def process_events(self):
         """Handle user input"""
-        key = cv2.waitKey(30)
+        key = cv2.waitKey(1)
 
         if key == ord('q'):
             self.stop()
@@ -234,18 +407,15 @@ class Beholder:
             self.toggle_recording()
 
         elif key in [ord('t'), ord('b'), 85, 86]:
-            if FORCE_RECORDING_ON_TRIAL and not self.ev_recording.is_set():
-                # make sure recording is running when we toggle a trial!
-                logging.warning('Force starting recording on trial initiation. Someone forgot to press record?')
-                self.toggle_recording(True)
-
-            # Start/stop a trial period
-            self.toggle_trial()
+            self.trial_event()
 
         # Stub event to notify of issues for later review.
         elif key == ord('n'):
-            self.notes.append(time.time())
-            logging.warning('Something happened! Take note!')
+            self.add_note()
+
+        # Performance HUD
+        elif key == ord('h'):
+            self.hud.toggle()
 
         elif key == ord(' ') and CAN_BE_PAUSED:
             self.paused = not self.paused
@@ -256,6 +426,81 @@ class Beholder:
         if cv2.getWindowProperty('Beholder', cv2.WND_PROP_AUTOSIZE) < 1:
             self.stop()
 
+        if self.control is not None and not self.ev_stop.is_set():
+            self.control.poll()
+
+    def loop_headless(self):
+        """Record without display, controlled over the control socket.
+        """
+        logging.info('Running headless')
+        try:
+            while not self.ev_stop.is_set():
+                if not all([thread.is_alive() for thread in self.ingest_threads]):
+                    self.stop()
+                    break
+                self.control.poll(CONTROL_POLL_INTERVAL)
+
+        except KeyboardInterrupt:
+            self.stop()
+
+        self.control.close()
+
+    def trial_event(self, target_state=None):
+        """Start or stop a trial, as with the trial keys or the trial button.
+        """
+        if FORCE_RECORDING_ON_TRIAL and not self.ev_recording.is_set():
+            # make sure recording is running when we toggle a trial!
+            logging.warning('Force starting recording on trial initiation. Someone forgot to press record?')
+            self.toggle_recording(True)
+
+        # Start/stop a trial period
+        self.toggle_trial(target_state)
+
+    def add_note(self, text=None):
+        self.notes.append(time.time())
+        logging.warning('Something happened! Take note!' + (' {}'.format(text) if text else ''))
+
+    def status(self):
+        """Summary of the state of recording and sources, as published by the control server.
+        """
+        now = time.time()
+        # Seconds since the tiles were updated, none without display
+        tile_ages = None
+        if self.mosaic is not None:
+            tile_ages = [round(age, 3) if np.isfinite(age) else None for age in self.mosaic.age().tolist()]
+        return {'recording': self.ev_recording.is_set(),
+                'recording_path': str(self.recording_path) if self.recording_path is not None else None,
+                'recording_duration': now - self.timing_recording_start if self.timing_recording_start else None,
+                'trial_active': self.ev_trial_active.is_set(),
+                'trial_duration': now - self.timing_trial_start if self.timing_trial_start else None,
+                'writers_recording': [writer.recording for writer in self.writers],
+                'sources_timed_out': [grabber.timed_out for grabber in self.grabbers],
+                'tile_ages': tile_ages,
+                'write_queues': [len(queue) for queue in self.write_queues],
+                'disk_free_gb': self.monitor.free / 2 ** 30,
+                'disk_remaining': self.monitor.remaining,
+                'degradation_level': self.monitor.level,
+                'n_notes': len(self.notes)}
+
+    def register_metrics(self):
+        """Frame counts, queue depth and latencies of each source, and the state of the Beholder.
+        """
+        for n, (grabber, queue, writer) in enumerate(zip(self.grabbers, self.write_queues, self.writers)):
+            tags = {'source': '{:02d}'.format(n + 1)}
+            self.metrics.add('beholder_frames', tags, {'received': lambda g=grabber: g.n_frames,
+                                                       'decoded': lambda g=grabber: g.n_decoded,
+                                                       'bytes_copied': lambda g=grabber: g.n_bytes_copied,
+                                                       'written': lambda w=writer: w.n_frames,
+                                                       'dropped': lambda q=queue: q.n_dropped,
+                                                       'queue_depth': lambda q=queue: len(q)})
+            self.metrics.add('beholder_latency_ms', tags, {'network': grabber.network_latency,
+                                                          'encoder_write': writer.write_latency})
+
+        self.metrics.add('beholder', {}, {'recording': self.ev_recording.is_set,
+                                          'renders': lambda: self.n_rendered,
+                                          'degradation_level': lambda: self.monitor.level,
+                                          'disk_free_gb': lambda: self.monitor.free / 2 ** 30})
+
     def toggle_recording(self, target_state=None):
         self.t_phase = cv2.getTickCount()
 
@@ -281,6 +526,7 @@ class Beholder:
 
             self.recording_path = rec_path
             self.recording_ts = ts
+            self._first_segment_key = None
             self.ev_recording.set()
             self.timing_recording_start = time.time()
 
@@ -291,6 +537,14 @@ class Beholder:
             self.recording_ts = None
             self.timing_recording_start = None
 
+    def first_segment_key(self, key):
+        """Key of the first segment of the recording, shared by all Writers. The first Writer to ask sets it.
+        """
+        with self._segment_lock:
+            if self._first_segment_key is None:
+                self._first_segment_key = key
+            return self._first_segment_key
+
     def toggle_trial(self, target_state=None):
         # gather the new state from current state, else override
         target_state = target_state if target_state is not None else not self.ev_trial_active.is_set()
@@ -320,7 +574,8 @@ class Beholder:
             self.measure_points[1] = (x, y)
 
             if None not in self.measure_points:
-                p1, p2 = self.measure_points
+                # Measure in full resolution pixels, the scale factors refer to the original camera frames
+                p1, p2 = [(x * self.preview_scale, y * self.preview_scale) for x, y in self.measure_points]
                 distance = euclidean_distance(p1, p2)
                 distance_m_floor = distance * self.cfg['scale_floor']
                 distance_m_arena = distance * self.cfg['scale_arena']
@@ -328,24 +583,33 @@ class Beholder:
                 dy = abs(p1[1] - p2[1])
                 logging.info(
                     f'({p1}; {p2}) | l: {distance:.1f} px, -arena-: {distance_m_arena:.0f} mm,'
-                    ' _floor_: {distance_m_floor:.0f} mm, dx: {dx}, dy: {dy}')
+                    f' _floor_: {distance_m_floor:.0f} mm, dx: {dx}, dy: {dy}')
 
     def stop(self):
         self.ev_stop.set()
         logging.debug('Join request sent!')
 
         # Shut down Grabbers
-        for grabber in self.grabbers:
-            if grabber.is_alive():
-                grabber.join()
+        for thread in self.ingest_threads:
+            if thread.is_alive():
+                thread.join()
         logging.debug('All Grabbers joined!')
 
+        if self.decoder is not None:
+            self.decoder.close()
+
         # Shut down Writers
         for writer in self.writers:
             if writer.is_alive():
                 writer.join()
         logging.debug('All Writers joined!')
 
+        if self.mover is not None:
+            self.mover.finish()
+
+        if self.mosaic is not None:
+            self.mosaic.close()
+
         if len(self.notes):
             logging.warning('There were {} events marked!'.format(len(self.notes)))
 
@@ -357,6 +621,51 @@ def main():
     parser.add_argument('-c', '--config', help='Non-default configuration file to use')
     parser.add_argument('--no_crop', help='Override crop options, show full frames.', action='store_true')
     parser.add_argument('--alignment', help='Draw alignment markers on the frame', action='store_true')
+    parser.add_argument('--preview_scale', type=int, choices=sorted(PREVIEW_IMREAD_FLAGS), default=PREVIEW_SCALE,
+                        help='Decode frames for display at 1/N resolution')
+    parser.add_argument('--headless', action='store_true',
+                        help='Record without display, controlled over the control socket (implies --control)')
+    parser.add_argument('--control', action='store_true',
+                        help=f'Accept commands on port {CONTROL_PORT} and publish status on port {STATUS_PORT}')
+    parser.add_argument('--stream', action='store_true',
+                        help=f'Publish the mosaic as JPEG frames on port {MOSAIC_STREAM_PORT} while anyone subscribes')
+    parser.add_argument('--stream_http', type=int, metavar='PORT',
+                        help='Also serve the mosaic stream as MJPEG over HTTP')
+    parser.add_argument('--stream_width', type=int, default=MOSAIC_STREAM_WIDTH, help='Width of the streamed mosaic')
+    parser.add_argument('--stream_fps', type=float, default=MOSAIC_STREAM_FPS, help='Maximum rate of the mosaic stream')
+    parser.add_argument('--stream_quality', type=int, default=MOSAIC_STREAM_QUALITY,
+                        help='JPEG quality of the mosaic stream (0-100)')
+    parser.add_argument('--export', nargs='?', const=MOSAIC_SHM_NAME, metavar='NAME',
+                        help=f'Export the mosaic as /dev/shm/NAME (default {MOSAIC_SHM_NAME}) for other processes, see '
+                             f'beholder.mosaic.MosaicReader')
+    parser.add_argument('--hud', action='store_true', help="Start with the performance HUD shown, toggle with 'h'")
+    parser.add_argument('--metrics', metavar='TARGET',
+                        help=f'Send pipeline metrics in InfluxDB line protocol to udp://host[:port] (default port '
+                             f'{METRICS_UDP_PORT}) or append them to a file')
+    parser.add_argument('--display_fps', type=float, default=DISPLAY_FPS, help='Maximum display refresh rate')
+    parser.add_argument('--decimate', action='store_true',
+                        help='Decode only the newest frame per source and displayed mosaic. Recording is unaffected.')
+    parser.add_argument('--multiplexed', action='store_true',
+                        help='Receive from all sources in a single thread instead of one thread per source')
+    parser.add_argument('--pretrigger', type=float, default=PRETRIGGER_DURATION,
+                        help='Seconds of frames before the start of a recording to include in the recording')
+    parser.add_argument('--encoder', choices=['auto'] + sorted(ENCODERS), default=DEFAULT_ENCODER,
+                        help='Recording backend. auto benchmarks the available backends at startup (can take several '
+                             'seconds) and picks one fast enough.')
+    parser.add_argument('--spool', help='Record to this (fast, local) directory first, finished segments are moved to '
+                                        'the output directory in the background')
+    parser.add_argument('--warm', action='store_true',
+                        help='Start encoders ahead of recording. Videos are moved into the recording once finished.')
+    parser.add_argument('--segment_minutes', type=float,
+                        help='Split recordings into segments of this many minutes, aligned for all eyes')
+    parser.add_argument('--segment_frames', type=int,
+                        help='Split recordings into segments of this many frames, counted per eye')
+    parser.add_argument('--metadata', choices=['csv', 'binary'], default=METADATA_FORMAT,
+                        help='Frame metadata file format. Convert binary files with `python -m beholder.metadata`.')
+    parser.add_argument('--write_overflow', choices=OVERFLOW_POLICIES, default=WRITE_OVERFLOW_POLICY,
+                        help='What to do with frames when a write queue is full')
+    parser.add_argument('--decode_workers', type=int, default=DECODE_WORKERS,
+                        help='Number of processes decoding frames for display. 0 decodes in the Grabber threads.')
 
     cli_args = parser.parse_args()
 
@@ -424,6 +733,44 @@ def main():
         cfg['frame_crop_y'] = 0
 
     cfg['alignment_markers'] = cli_args.alignment
+    cfg['decode_workers'] = cli_args.decode_workers
+    cfg['display_decimation'] = cli_args.decimate
+    cfg['display_fps'] = cli_args.display_fps
+    cfg['hud'] = cli_args.hud
+    cfg['metrics'] = cli_args.metrics
+    cfg['headless'] = cli_args.headless
+    cfg['control'] = cli_args.control
+    cfg['export'] = cli_args.export
+    cfg['stream'] = cli_args.stream or cli_args.stream_http is not None
+    cfg['stream_http'] = cli_args.stream_http
+    cfg['stream_width'] = cli_args.stream_width
+    cfg['stream_fps'] = cli_args.stream_fps
+    cfg['stream_quality'] = cli_args.stream_quality
+    cfg['preview_scale'] = cli_args.preview_scale
+    cfg['multiplexed_ingest'] = cli_args.multiplexed
+    cfg['pretrigger'] = cli_args.pretrigger
+    cfg['write_overflow'] = cli_args.write_overflow
+    cfg['encoder'] = cli_args.encoder
+    cfg['metadata_format'] = cli_args.metadata
+    cfg['warm_encoders'] = cli_args.warm or WARM_ENCODERS
+    cfg['spool_path'] = Path(cli_args.spool).expanduser().resolve() if cli_args.spool else None
+    if cfg['spool_path'] is not None and not cfg['spool_path'].exists():
+        logging.warning(f"Spool directory '{cfg['spool_path']}' does not exist! Attempting to create...")
+        cfg['spool_path'].mkdir(parents=True)
+
+    cfg['segment_length'] = SEGMENT_LENGTH
+    cfg['segment_frames'] = 0
+    if cli_args.segment_minutes:
+        cfg['segment_length'] = cli_args.segment_minutes * 60
+    elif cli_args.segment_frames:
+        cfg['segment_length'] = 0
+        cfg['segment_frames'] = cli_args.segment_frames
+
+    if cfg['encoder'] == 'auto':
+        cfg['encoder'] = probe_encoders(cfg, len(cfg['sources']))
+    elif not ENCODERS[cfg['encoder']].available():
+        logging.error('Encoder {} is not available!'.format(cfg['encoder']))
+        sys.exit(1)
 
     beholder = Beholder(cfg)
     beholder.loop()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from beholder.defaults import *
+
+# Metadata of the eyes plus what the Grabber adds on reception, and the seconds recording was interrupted before a
+# frame by an encoder failure, only set for the first frame after the failure
+METADATA_DTYPE = np.dtype(PIEYE_METADATA_DTYPE + [('recv_clock_ts', '<f8'), ('bytes', '<i8'), ('downtime', '<f8')])
+
+# Fill values of fields missing in metadata of eyes sending the deprecated frame format
+METADATA_MISSING = {'name': b'', 'frame_index': -1, 'frame_gpu_ts': -1, 'callback_gpu_ts': -1,
+                    'callback_clock_ts': np.nan, 'recv_clock_ts': np.nan, 'bytes': -1, 'downtime': np.nan}
+
+
+class CsvMetadataLog:
+    """Per-frame metadata as rows of a csv file.
+    """
+    suffix = '.meta'
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'w', newline='')
+        self._csv = csv.writer(self._file)
+        self._fields = None
+
+    def write(self, metadata):
+        """Write the metadata dicts of a batch of frames.
+
+        Columns are the keys of the first frame plus downtime, which only a few frames have.
+        """
+        for md in metadata:
+            if self._fields is None:
+                self._fields = list(md.keys())
+                if 'downtime' not in self._fields:
+                    self._fields.append('downtime')
+                self._csv.writerow(self._fields)
+            self._csv.writerow([md.get(field) for field in self._fields])
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class BinaryMetadataLog:
+    """Per-frame metadata as an append-only file of METADATA_DTYPE records.
+
+    Records are collected and written in batches of METADATA_BATCH_SIZE. The file has no header and can be
+    mapped with `load_metadata`.
+    """
+    suffix = '.metab'
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'wb')
+        self._batch = np.zeros(METADATA_BATCH_SIZE, dtype=METADATA_DTYPE)
+        self._n = 0
+
+    def write(self, metadata):
+        """Write the metadata dicts of a batch of frames.
+        """
+        for md in metadata:
+            record = []
+            for field in METADATA_DTYPE.names:
+                value = md.get(field)
+                if value is None:
+                    value = METADATA_MISSING[field]
+                elif field == 'name':
+                    value = value.encode()
+                record.append(value)
+
+            self._batch[self._n] = tuple(record)
+            self._n += 1
+            if self._n == len(self._batch):
+                self.flush()
+
+    def flush(self):
+        self._batch[:self._n].tofile(self._file)
+        self._file.flush()
+        self._n = 0
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+
+METADATA_LOGS = {'csv': CsvMetadataLog, 'binary': BinaryMetadataLog}
+
+
+def load_metadata(path):
+    """Memory map a binary metadata file as a record array of METADATA_DTYPE.
+
+    A partial record at the end, e.g. of a file cut short by a crash, is left out.
+    """
+    size = Path(path).stat().st_size
+    n_records, remainder = divmod(size, METADATA_DTYPE.itemsize)
+    if remainder:
+        logging.warning('{} ends in a partial record, ignoring its last {} bytes'.format(path, remainder))
+    if not n_records:
+        return np.zeros(0, dtype=METADATA_DTYPE)
+    return np.memmap(path, dtype=METADATA_DTYPE, mode='r', shape=(n_records,))
+
+
+def metadata_to_csv(path, csv_path=None):
+    """Convert a binary metadata file into the csv format of CsvMetadataLog.
+    """
+    path = Path(path)
+    csv_path = path.with_suffix(CsvMetadataLog.suffix) if csv_path is None else Path(csv_path)
+    records = load_metadata(path)
+
+    with open(csv_path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(METADATA_DTYPE.names)
+        for record in records.tolist():
+            writer.writerow((record[0].decode().strip(),) + record[1:])
+
+    logging.info('Converted {} records of {} to {}'.format(len(records), path, csv_path))
+    return csv_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert binary BeholderPi frame metadata to csv.')
+    parser.add_argument('paths', nargs='+', help='Binary metadata (.metab) files')
+
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - {%(levelname)s} %(message)s')
+
+    for path in cli_args.paths:
+        metadata_to_csv(path)
+
+
+if __name__ == '__main__':
+    main()
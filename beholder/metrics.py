@@ -0,0 +1,174 @@
+import logging
+import math
+import socket
+import threading
+import time
+from bisect import bisect_left
+from itertools import accumulate
+from pathlib import Path
+from urllib.parse import urlparse
+
+from beholder.defaults import *
+
+
+class Histogram:
+    """Counts of observed values in buckets with upper bounds `bounds`, plus a bucket for values above.
+
+    Only ever updated by a single thread, and read by the Metrics thread without locking. A snapshot taken during an
+    update may be off by the one value being recorded. The maximum covers the values since the last snapshot.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.n = 0
+        self.sum = 0.
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.n += 1
+
+    def snapshot(self):
+        maximum, self.max = self.max, None
+        return self.counts.copy(), self.n, self.sum, maximum
+
+
+class Metrics(threading.Thread):
+    """Pipeline health of the Beholder, flushed every METRICS_INTERVAL seconds in InfluxDB line protocol.
+
+    Measurements are registered with their tags and fields. Fields are callables returning the current value of a
+    counter or gauge the pipeline stages keep anyway, or Histograms. Nothing is locked or copied on the hot path,
+    values are read when flushing. Counters are cumulative, histograms add the 50th, 95th and 99th percentiles (upper
+    bucket bounds, the largest value observed for percentiles above all buckets) of the values observed since the
+    last flush.
+
+    The target is either a UDP endpoint, `udp://host:port` (telegraf socket_listener or InfluxDB UDP service), or a
+    file that lines are appended to.
+    """
+
+    def __init__(self, target, ev_stop, interval=METRICS_INTERVAL):
+        super().__init__(name='Metrics', daemon=True)
+        self._ev_stop = ev_stop
+        self.interval = interval
+
+        url = urlparse(target)
+        if url.scheme == 'udp':
+            self._address = url.hostname, url.port or METRICS_UDP_PORT
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._path = None
+        else:
+            self._address = self._socket = None
+            self._path = Path(target).expanduser()
+
+        self.tags = {'host': socket.gethostname()}
+        self._measurements = []
+        self._last = {}
+        logging.info('Metrics to {} every {} s'.format(target, interval))
+
+    def add(self, measurement, tags, fields):
+        """Register a measurement with a dict of tags, and a dict of fields, each a callable or a Histogram.
+        """
+        tags = ''.join(',{}={}'.format(_escape(k), _escape(v)) for k, v in sorted({**self.tags, **tags}.items()))
+        self._measurements.append((_escape(measurement) + tags, fields))
+
+    def run(self):
+        while not self._ev_stop.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def lines(self):
+        """Current values of all measurements in line protocol.
+        """
+        ts = time.time_ns()
+        lines = []
+        for key, fields in self._measurements:
+            values = []
+            for name, field in fields.items():
+                if isinstance(field, Histogram):
+                    values.extend(self._histogram_fields(key, name, field))
+                else:
+                    values.append((name, field()))
+
+            fields_str = ','.join('{}={}'.format(_escape(name), _value(value)) for name, value in values
+                                  if value is not None and not (isinstance(value, float) and math.isnan(value)))
+            if fields_str:
+                lines.append('{} {} {}'.format(key, fields_str, ts))
+        return lines
+
+    def _histogram_fields(self, key, name, histogram):
+        counts, n, total, maximum = histogram.snapshot()
+        last_counts, last_n = self._last.get((key, name), ([0] * len(counts), 0))
+        self._last[key, name] = counts, n
+
+        # Always a float field, the type of a field must not change between flushes
+        fields = [(name + '_count', n), (name + '_sum', total),
+                  (name + '_max', None if maximum is None else float(maximum))]
+        # Cumulative bucket counts, values above the last bound are only in the total count
+        fields.extend(('{}_le_{:g}'.format(name, bound), count)
+                      for bound, count in zip(histogram.bounds, accumulate(counts)))
+
+        # Percentiles of the values observed since the last flush
+        n_interval = n - last_n
+        if n_interval > 0:
+            deltas = [count - last for count, last in zip(counts, last_counts)]
+            for q in (50, 95, 99):
+                fields.append(('{}_p{}'.format(name, q), _quantile(histogram.bounds, deltas, n_interval * q / 100,
+                                                                   maximum)))
+        return fields
+
+    def flush(self):
+        lines = self.lines()
+        if not lines:
+            return
+        try:
+            if self._socket is not None:
+                for payload in _packets(lines, METRICS_UDP_PAYLOAD):
+                    self._socket.sendto(payload, self._address)
+            else:
+                with open(self._path, 'a') as f:
+                    f.write('\n'.join(lines) + '\n')
+        except OSError as e:
+            logging.warning('Failed to flush metrics: {}'.format(e))
+
+
+def _quantile(bounds, counts, rank, maximum):
+    """Upper bound of the bucket holding the value of `rank`, the largest value of the interval above all buckets.
+
+    Line protocol has no infinity for the open bucket.
+    """
+    cumulative = 0
+    for bound, count in zip(bounds, counts):
+        cumulative += count
+        if cumulative >= rank:
+            return float(bound)
+    return float(maximum)
+
+
+def _packets(lines, max_size):
+    """Group lines into datagrams of at most `max_size` bytes, unless a single line is longer.
+    """
+    payload = b''
+    for line in lines:
+        line = line.encode() + b'\n'
+        if payload and len(payload) + len(line) > max_size:
+            yield payload
+            payload = b''
+        payload += line
+    if payload:
+        yield payload
+
+
+def _escape(s):
+    return str(s).replace(' ', r'\ ').replace(',', r'\,').replace('=', r'\=')
+
+
+def _value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return '{}i'.format(value)
+    return repr(float(value))
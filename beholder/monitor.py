@@ -0,0 +1,129 @@
+import logging
+import shutil
+import threading
+import time
+from collections import deque
+
+from beholder.defaults import *
+from beholder.util import fmt_time
+
+
+class DiskMonitor(threading.Thread):
+    """Watch free space of the output disk and how well the Writers keep up with the incoming frames.
+
+    Projects the remaining recording time from the drop in free space while recording. When Writers fall behind,
+    the degradation level is raised step by step: first the preview is decimated to the display rate, then its
+    decoding is switched off, then new encoders are started at a lower bitrate. Levels are lifted again once the
+    Writers have caught up.
+    """
+
+    def __init__(self, cfg, path, writers, grabbers, ev_stop, ev_recording):
+        super().__init__(name='DiskMonitor', daemon=True)
+        self.cfg = cfg
+        self.path = path
+        self.writers = writers
+        self.grabbers = grabbers
+        self._ev_stop = ev_stop
+        self._ev_recording = ev_recording
+
+        self.free = shutil.disk_usage(path).free
+        self._free_samples = deque(maxlen=DISK_MONITOR_WINDOW)
+        self.consumption = 0.  # bytes per second
+        self.remaining = None  # seconds of recording until DISK_MIN_GB are left
+        self._remaining_warned = False
+
+        # Per Writer rates of frames coming in and bytes handed to the encoder, and fraction of time blocked on the
+        # encoder. Writers behind but not blocked wait on the disk (metadata) or the CPU.
+        self.frames_in_per_s = [0.] * len(writers)
+        self.frames_out_per_s = [0.] * len(writers)
+        self.bytes_per_s = [0.] * len(writers)
+        self.blocked = [0.] * len(writers)
+        self._last = None
+
+        self.level = 0
+        self._n_behind = 0
+        self._n_ok = 0
+
+    def run(self):
+        while not self._ev_stop.wait(DISK_MONITOR_INTERVAL):
+            try:
+                self.sample()
+            except OSError as e:
+                logging.error('Disk monitor failed to sample {}: {}'.format(self.path, e))
+
+    def sample(self):
+        now = time.monotonic()
+        self.free = shutil.disk_usage(self.path).free
+        recording = self._ev_recording.is_set()
+
+        # Remaining recording time from the free space consumed over the window
+        if recording:
+            self._free_samples.append((now, self.free))
+        else:
+            self._free_samples.clear()
+            self.remaining = None
+            self._remaining_warned = False
+
+        if len(self._free_samples) > 1:
+            (t0, free0), (t1, free1) = self._free_samples[0], self._free_samples[-1]
+            self.consumption = max(0., (free0 - free1) / (t1 - t0))
+            if self.consumption:
+                self.remaining = max(0., self.free - DISK_MIN_GB * 2 ** 30) / self.consumption
+                if self.remaining < DISK_REMAINING_WARN and not self._remaining_warned:
+                    logging.warning('Disk space for only {} of recording left!'.format(fmt_time(self.remaining)[:8]))
+                    self._remaining_warned = True
+
+        counts = [(writer.in_queue.n_put, writer.in_queue.n_dropped, writer.n_frames, writer.n_bytes_written,
+                   writer.t_blocked) for writer in self.writers]
+        behind = False
+        if self._last is not None:
+            t_last, last = self._last
+            dt = now - t_last
+            for n, ((n_put, n_dropped, n_frames, n_bytes, t_blocked), (p_put, p_dropped, p_frames, p_bytes,
+                                                                       p_blocked)) in enumerate(zip(counts, last)):
+                self.frames_in_per_s[n] = (n_put - p_put) / dt
+                self.frames_out_per_s[n] = (n_frames - p_frames) / dt
+                self.bytes_per_s[n] = (n_bytes - p_bytes) / dt
+                self.blocked[n] = (t_blocked - p_blocked) / dt
+
+                queue = self.writers[n].in_queue
+                if recording and (n_dropped > p_dropped or len(queue) > queue.capacity * DEGRADE_QUEUE_FILL):
+                    behind = True
+        self._last = now, counts
+
+        self.update_level(behind)
+
+    def update_level(self, behind):
+        """Raise the degradation level when Writers are behind repeatedly, lower it once they have caught up.
+        """
+        self._n_behind = self._n_behind + 1 if behind else 0
+        self._n_ok = 0 if behind else self._n_ok + 1
+
+        level = self.level
+        if self._n_behind >= DEGRADE_SAMPLES and level < MAX_DEGRADE_LEVEL:
+            level += 1
+            self._n_behind = 0
+            logging.warning('Writers falling behind at {:.1f} MB/s, up to {:.0%} blocked on encoders, degradation '
+                            'level {}'.format(sum(self.bytes_per_s) / 2 ** 20, max(self.blocked), level))
+        elif self._n_ok >= RECOVER_SAMPLES and level > 0:
+            level -= 1
+            self._n_ok = 0
+            logging.info('Writers caught up, degradation level {}'.format(level))
+
+        if level != self.level:
+            self.level = level
+            for grabber in self.grabbers:
+                grabber.display_decimation = level >= 1 or self.cfg['display_decimation']
+                grabber.preview_enabled = level < 2 and not self.cfg['headless']
+            for writer in self.writers:
+                writer.low_bitrate = level >= 3
+
+    def status(self):
+        """Single line summary for display on the mosaic.
+        """
+        text = 'Disk {:.0f} GB'.format(self.free / 2 ** 30)
+        if self.remaining is not None:
+            text += ', {} left'.format(fmt_time(self.remaining)[:5])
+        if self.level:
+            text += ' [degraded {}]'.format(self.level)
+        return text
@@ -0,0 +1,357 @@
+import ctypes
+import logging
+import multiprocessing as mp
+import os
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from beholder.defaults import *
+from beholder.util import tile_slices
+
+
+# Header of the mosaic memory: magic, layout version, mosaic height, width and colors, number of tiles and buffers,
+# tile columns, tile height and width, and the pid of the exporting process. The arrays described by _layout follow.
+MOSAIC_HEADER = struct.Struct('<8s10I')
+MOSAIC_MAGIC = b'BEHOLDER'
+MOSAIC_VERSION = 1
+
+
+def _layout(shape, n_tiles, n_buffers):
+    """Offsets, dtypes and shapes of the arrays in the mosaic memory, and its total size.
+
+    Generations and update times (time.monotonic) are per tile, frame indices and capture timestamps of the eyes per
+    buffer and tile. Buffers are aligned to 64 bytes.
+    """
+    arrays = {}
+    offset = 64
+    for name, dtype, arr_shape in [('gen', np.uint64, (n_tiles,)),
+                                   ('t_update', np.float64, (n_tiles,)),
+                                   ('frame_index', np.int64, (n_buffers, n_tiles)),
+                                   ('timestamp', np.float64, (n_buffers, n_tiles))]:
+        arrays[name] = offset, dtype, arr_shape
+        offset += int(np.prod(arr_shape)) * np.dtype(dtype).itemsize
+    offset = -(-offset // 64) * 64
+    arrays['buffers'] = offset, np.ubyte, (n_buffers,) + tuple(shape)
+    return arrays, offset + int(np.prod(shape)) * n_buffers
+
+
+def _map(buf, shape, n_tiles, n_buffers):
+    """Numpy views of the arrays in the mosaic memory `buf`.
+    """
+    arrays, _ = _layout(shape, n_tiles, n_buffers)
+    return {name: np.frombuffer(buf, dtype=dtype, count=int(np.prod(arr_shape)), offset=offset).reshape(arr_shape)
+            for name, (offset, dtype, arr_shape) in arrays.items()}
+
+
+def _attach_untracked(name):
+    """Attach to an existing shared memory segment, which the resource tracker must not remove when we exit.
+    """
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name, track=False)
+    shm = SharedMemory(name)
+    if os.name == 'posix':
+        # Registered under the name with the leading slash of POSIX shared memory
+        resource_tracker.unregister('/' + shm.name, 'shared_memory')
+    return shm
+
+
+def _remove_orphan(name):
+    """Remove the mosaic /dev/shm/<name> left behind by a Beholder that is gone. Raises FileExistsError if the
+    segment is not a mosaic or its Beholder is still running.
+    """
+    shm = _attach_untracked(name)
+    try:
+        header = MOSAIC_HEADER.unpack_from(shm.buf) if shm.size >= MOSAIC_HEADER.size else None
+    finally:
+        shm.close()
+
+    if header is None or header[0] != MOSAIC_MAGIC or header[1] != MOSAIC_VERSION:
+        raise FileExistsError('/dev/shm/{} exists and is not a mosaic, export under another name'.format(name))
+    if _running(header[-1]):
+        raise FileExistsError('/dev/shm/{} is exported by running process {}, export under another name'.format(
+            name, header[-1]))
+
+    logging.warning('Replacing orphaned shared mosaic /dev/shm/{} of process {}'.format(name, header[-1]))
+    stale = SharedMemory(name)
+    stale.close()
+    stale.unlink()
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedMosaic:
+    """Preview tiles of all sources in shared memory, writable from Grabber threads and decode worker processes.
+
+    Tiles are buffered MOSAIC_BUFFERS times and guarded seqlock-style by a generation counter per tile. A writer
+    fills the buffer after the current one and only then increments the generation, so it never waits for readers.
+    Readers copy the current buffer and check the generation again, retrying if the writer may have lapped them.
+    A tile must only have a single writer at a time: its Grabber thread, or while the Grabber has a frame in flight,
+    the decode pool.
+
+    The time of the last update of each tile tells stale tiles apart. Sources that stopped sending get the no signal
+    frame, with a frame index of -1.
+
+    With a `name`, the mosaic is exported as /dev/shm/<name> for other processes to read with a MosaicReader.
+    """
+
+    def __init__(self, cfg, n_tiles, n_buffers=MOSAIC_BUFFERS, name=None):
+        self.shape = cfg['shared_shape']
+        self.n_tiles = n_tiles
+        self.n_buffers = n_buffers
+
+        # Slices of tile and source frame crop of each tile
+        self.tiles = [tile_slices(cfg, idx) for idx in range(n_tiles)]
+        self.tile_height = cfg['cropped_frame_height']
+        self.tile_width = cfg['cropped_frame_width']
+        self.n_cols = cfg['n_cols']
+
+        _, size = _layout(self.shape, n_tiles, n_buffers)
+        if name is None:
+            self.shm = None
+            self.arr = mp.RawArray(ctypes.c_ubyte, size)
+        else:
+            try:
+                self.shm = SharedMemory(name, create=True, size=size)
+            except FileExistsError:
+                _remove_orphan(name)
+                self.shm = SharedMemory(name, create=True, size=size)
+            self.arr = None
+            logging.info('Exporting mosaic as /dev/shm/{}'.format(name))
+
+        self._attach()
+        header = MOSAIC_HEADER.pack(MOSAIC_MAGIC, MOSAIC_VERSION, *self.shape, n_tiles, n_buffers, self.n_cols,
+                                    self.tile_height, self.tile_width, os.getpid())
+        self._buf[:MOSAIC_HEADER.size] = np.frombuffer(header, dtype=np.ubyte)
+        self.frame_index[:] = -1
+        self.timestamp[:] = np.nan
+
+    def _attach(self):
+        self._buf = np.frombuffer(self.arr if self.shm is None else self.shm.buf, dtype=np.ubyte)
+        self.__dict__.update(_map(self._buf, self.shape, self.n_tiles, self.n_buffers))
+
+    def __getstate__(self):
+        # Numpy views would be pickled as copies, they are recreated on the other side
+        state = self.__dict__.copy()
+        for name in ['_buf', 'gen', 't_update', 'frame_index', 'timestamp', 'buffers']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def update(self, idx, frame, frame_index=-1, timestamp=np.nan):
+        """Copy the crop of a (flipped) preview frame into its tile. Raises ValueError if the frame doesn't fit.
+
+        `frame_index` and `timestamp` (callback_clock_ts) of the frame are kept with the tile, -1 and nan for
+        frames not from the source, like the no signal frame.
+        """
+        tile, crop = self.tiles[idx]
+        gen = int(self.gen[idx]) + 1
+        buffer = gen % self.n_buffers
+        self.buffers[buffer][tile] = frame[crop]
+        self.frame_index[buffer, idx] = frame_index
+        self.timestamp[buffer, idx] = timestamp
+        self.t_update[idx] = time.monotonic()
+        self.gen[idx] = gen
+
+    def read(self, idx, out):
+        """Copy the newest complete frame of tile `idx` into the mosaic sized array `out`.
+
+        Returns the generation copied, or None if the writer overtook every try and `out` may hold a torn tile.
+        """
+        tile, _ = self.tiles[idx]
+        for _ in range(self.n_buffers):
+            gen = int(self.gen[idx])
+            out[tile] = self.buffers[gen % self.n_buffers][tile]
+            # The writer of generation gen + n_buffers - 1 onwards may be writing into the buffer just copied
+            if int(self.gen[idx]) - gen < self.n_buffers - 1:
+                return gen
+        return None
+
+    def changed(self, seen):
+        """Indices of tiles updated since generations `seen`.
+        """
+        return np.flatnonzero(self.gen != seen)
+
+    def age(self):
+        """Seconds since the last update of each tile, inf for tiles never updated.
+        """
+        t_update = self.t_update.copy()
+        return np.where(t_update > 0, time.monotonic() - t_update, np.inf)
+
+    def close(self):
+        """Remove the exported mosaic. Readers attached keep their mapping until they close it.
+
+        The mosaic stays readable from a private copy of its last state, e.g. for a last status report.
+        """
+        if self.shm is None:
+            return
+        self._buf = self._buf.copy()
+        self.__dict__.update(_map(self._buf, self.shape, self.n_tiles, self.n_buffers))
+        try:
+            self.shm.close()
+        except BufferError:
+            logging.debug('Shared mosaic still referenced, unlinking only')
+        self.shm.unlink()
+        self.shm = None
+
+    def tiles_in_rect(self, x0, y0, x1, y1):
+        """Indices of the tiles overlapping a rectangle of the mosaic.
+        """
+        n_rows = self.n_tiles // self.n_cols + bool(self.n_tiles % self.n_cols)
+        cols = range(max(0, x0 // self.tile_width), min(self.n_cols - 1, x1 // self.tile_width) + 1)
+        rows = range(max(0, y0 // self.tile_height), min(n_rows - 1, y1 // self.tile_height) + 1)
+        return [idx for idx in (row * self.n_cols + col for row in rows for col in cols) if idx < self.n_tiles]
+
+
+class RenderScheduler:
+    """Wakes the display when tiles of the mosaic were updated, at no more than `fps` renders per second.
+
+    Keeps the arrival time of the newest frame of each tile, to measure the latency from frame arrival to display.
+    """
+
+    def __init__(self, n_tiles, fps=DISPLAY_FPS):
+        self.min_interval = 1 / fps if fps else 0.
+        self._cond = threading.Condition()
+        self._pending = False
+        self._t_render = 0.
+
+        self._t_arrival = [None] * n_tiles
+        self.latency = [deque(maxlen=N_FRAMES_FPS_LOG) for _ in range(n_tiles)]
+        self._t_report = time.monotonic()
+
+    def notify(self, idx, t_arrival):
+        """Tile `idx` was updated with a frame received at `t_arrival` (time.monotonic).
+        """
+        with self._cond:
+            self._t_arrival[idx] = t_arrival
+            self._pending = True
+            self._cond.notify()
+
+    def wait(self, timeout=DISPLAY_IDLE_INTERVAL):
+        """Wait until tiles were updated or `timeout` passed, but at least until the next render is due.
+
+        Returns the arrival times of the frames to be displayed by the render.
+        """
+        delay = self._t_render + self.min_interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        with self._cond:
+            if not self._pending:
+                self._cond.wait(timeout)
+            self._pending = False
+            arrivals, self._t_arrival = self._t_arrival, [None] * len(self._t_arrival)
+
+        self._t_render = time.monotonic()
+        return arrivals
+
+    def rendered(self, arrivals):
+        """Record latencies of the frames displayed by a render.
+        """
+        now = time.monotonic()
+        for idx, t_arrival in enumerate(arrivals):
+            if t_arrival is not None:
+                self.latency[idx].append(now - t_arrival)
+
+        if now - self._t_report > LATENCY_REPORT_INTERVAL:
+            self.report()
+            self._t_report = now
+
+    def latency_ms(self, idx):
+        """Mean latency from arrival to display of the last frames of tile `idx`.
+        """
+        latency = self.latency[idx]
+        return sum(latency) / len(latency) * 1000 if latency else None
+
+    def report(self):
+        stats = ', '.join('{}: {:.0f} ms'.format(idx + 1, self.latency_ms(idx))
+                          for idx in range(len(self.latency)) if self.latency[idx])
+        logging.info('Display latency {}'.format(stats))
+
+
+class MosaicReader:
+    """Read-only access to the mosaic exported by a running Beholder (--export NAME), from any process on the host.
+
+    Tiles are zero-copy views of the shared memory. Each tile has MOSAIC_BUFFERS buffers behind a generation counter,
+    a view stays valid only as long as `valid` holds for its generation. `read` returns a consistent copy instead.
+
+        reader = MosaicReader('beholder')
+        tile, gen, frame_index, timestamp = reader.read(3)
+    """
+
+    def __init__(self, name=MOSAIC_SHM_NAME):
+        self.shm = _attach_untracked(name)
+
+        magic, version, height, width, colors, self.n_tiles, self.n_buffers, self.n_cols, self.tile_height, \
+            self.tile_width, self.owner = MOSAIC_HEADER.unpack_from(self.shm.buf)
+        if magic != MOSAIC_MAGIC or version != MOSAIC_VERSION:
+            self.shm.close()
+            raise ValueError('/dev/shm/{} is not a mosaic of layout version {}'.format(name, MOSAIC_VERSION))
+        self.shape = height, width, colors
+
+        self.__dict__.update(_map(np.frombuffer(self.shm.buf, dtype=np.ubyte), self.shape, self.n_tiles,
+                                  self.n_buffers))
+
+    def tile_slices(self, idx):
+        n_row, n_col = divmod(idx, self.n_cols)
+        return (slice(self.tile_height * n_row, self.tile_height * (n_row + 1)),
+                slice(self.tile_width * n_col, self.tile_width * (n_col + 1)))
+
+    def tile(self, idx):
+        """View of the newest frame of tile `idx`, with its generation, frame index and timestamp.
+        """
+        gen = int(self.gen[idx])
+        buffer = gen % self.n_buffers
+        view = self.buffers[buffer][self.tile_slices(idx)]
+        return view, gen, int(self.frame_index[buffer, idx]), float(self.timestamp[buffer, idx])
+
+    def valid(self, idx, gen):
+        """Whether the buffer of generation `gen` of tile `idx` hasn't been touched by the writer yet.
+        """
+        return int(self.gen[idx]) - gen < self.n_buffers - 1
+
+    def read(self, idx, out=None):
+        """Copy the newest complete frame of tile `idx` into `out`, tile sized or None for a new array.
+
+        Returns the copy, its generation, frame index and timestamp, or None for the generation if the writer
+        overtook every try.
+        """
+        for _ in range(self.n_buffers):
+            view, gen, frame_index, timestamp = self.tile(idx)
+            if out is None:
+                out = view.copy()
+            else:
+                out[:] = view
+            if self.valid(idx, gen):
+                return out, gen, frame_index, timestamp
+        return out, None, -1, np.nan
+
+    def age(self):
+        """Seconds since the last update of each tile, inf for tiles never updated.
+        """
+        t_update = self.t_update.copy()
+        return np.where(t_update > 0, time.monotonic() - t_update, np.inf)
+
+    def close(self):
+        """Unmap the mosaic. Views returned by `tile` have to be released first.
+        """
+        for name in ['gen', 't_update', 'frame_index', 'timestamp', 'buffers']:
+            delattr(self, name)
+        self.shm.close()
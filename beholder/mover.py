@@ -0,0 +1,117 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from queue import Queue
+
+from beholder.defaults import *
+from beholder.writer import append_manifest
+
+
+class Mover(threading.Thread):
+    """Migrate finished segments from the spool directory to the output directory.
+
+    Files are copied in large sequential chunks at no more than MOVER_MAX_RATE, pausing while any write queue is
+    more than MOVER_YIELD_QUEUE_FILL full so the live recording always goes first. Copies are checked against the
+    sha256 digest of the spooled file before the spooled file is removed, the digests go into the manifest.
+    """
+
+    def __init__(self, write_queues, max_rate=MOVER_MAX_RATE):
+        super().__init__(name='Mover')
+        self.write_queues = write_queues
+        self.max_rate = max_rate
+
+        self._jobs = Queue()
+
+        self.n_moved = 0
+        self.n_bytes_moved = 0
+
+    def submit(self, files, dest, entry):
+        """Queue a finished segment for migration.
+
+        `files` maps the manifest field receiving the digest to the spooled file, `entry` is added to the manifest
+        in `dest` once all files have been moved.
+        """
+        self._jobs.put((files, dest, entry))
+
+    def finish(self):
+        """Move the remaining queued segments, then stop.
+        """
+        self._jobs.put(None)
+        if self._jobs.qsize() > 1:
+            logging.info('Moving {} remaining segments out of the spool'.format(self._jobs.qsize() - 1))
+        self.join()
+
+    def run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            self.migrate(*job)
+        logging.debug('Mover done, {} segments with {:.1f} MB moved'.format(self.n_moved, self.n_bytes_moved / 2 ** 20))
+
+    def migrate(self, files, dest, entry):
+        spool_dir = None
+        try:
+            dest.mkdir(parents=True, exist_ok=True)
+            for field, path in files.items():
+                entry[field] = self.copy(path, dest / path.name)
+                spool_dir = path.parent
+        except OSError as e:
+            # Keep the spooled files, and their manifest entry next to them
+            logging.error('Failed to move {} to {}: {}'.format(', '.join(p.name for p in files.values()), dest, e))
+            append_manifest(next(iter(files.values())).parent / MANIFEST_NAME, entry)
+            return
+
+        for path in files.values():
+            path.unlink()
+        try:
+            spool_dir.rmdir()
+        except OSError:
+            # Other segments of the recording still in the spool
+            pass
+
+        append_manifest(dest / MANIFEST_NAME, entry)
+        self.n_moved += 1
+
+    def copy(self, src, dst):
+        """Copy a file, verify the copy and return the sha256 digest of the source.
+        """
+        tmp = dst.with_name(dst.name + '.part')
+        digest = hashlib.sha256()
+        with open(src, 'rb') as f_src, open(tmp, 'wb') as f_dst:
+            for chunk in self.read_chunks(f_src):
+                f_dst.write(chunk)
+                digest.update(chunk)
+            f_dst.flush()
+            os.fsync(f_dst.fileno())
+
+        if MOVER_VERIFY:
+            check = hashlib.sha256()
+            with open(tmp, 'rb') as f_dst:
+                for chunk in self.read_chunks(f_dst):
+                    check.update(chunk)
+            if check.digest() != digest.digest():
+                tmp.unlink()
+                raise OSError('Checksum mismatch of copy {}'.format(dst))
+
+        tmp.replace(dst)
+        self.n_bytes_moved += dst.stat().st_size
+        return digest.hexdigest()
+
+    def read_chunks(self, f):
+        """Read a file in chunks, throttled and yielding to the Writers.
+        """
+        while True:
+            while any(len(queue) > queue.capacity * MOVER_YIELD_QUEUE_FILL for queue in self.write_queues):
+                time.sleep(MOVER_YIELD_INTERVAL)
+
+            t0 = time.monotonic()
+            chunk = f.read(MOVER_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+            if self.max_rate:
+                time.sleep(max(0., len(chunk) / self.max_rate - (time.monotonic() - t0)))
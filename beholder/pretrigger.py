@@ -0,0 +1,63 @@
+from collections import deque
+
+
+class PreTriggerBuffer:
+    """Ring buffer holding the last `duration` seconds of encoded frames of one source.
+
+    Frames are copied into a single preallocated byte pool, so memory use is bounded by `pool_size` bytes and the
+    heap does not fragment no matter how many frames pass through. If the pool is too small for `duration`
+    seconds of frames, the oldest frames are evicted early.
+    """
+
+    def __init__(self, duration, pool_size):
+        self.duration = duration
+        self.size = pool_size
+
+        self._pool = bytearray(pool_size)
+        self._view = memoryview(self._pool)
+        self._head = 0
+
+        # (offset, length, metadata) of buffered frames, oldest first
+        self._frames = deque()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def append(self, metadata, frame):
+        """Copy a frame into the pool, evicting frames it overwrites or that are older than `duration`.
+        """
+        n = len(frame)
+        if n > self.size:
+            return
+
+        # Frames between the write position and the end of the pool are the oldest, discard them and wrap around
+        if self._head + n > self.size:
+            while self._frames and self._frames[0][0] >= self._head:
+                self._frames.popleft()
+            self._head = 0
+
+        start, end = self._head, self._head + n
+        while self._frames and start <= self._frames[0][0] < end:
+            self._frames.popleft()
+
+        self._view[start:end] = frame
+        self._frames.append((start, n, metadata))
+        self._head = end
+
+        t = metadata['recv_clock_ts']
+        while self._frames and t - self._frames[0][2]['recv_clock_ts'] > self.duration:
+            self._frames.popleft()
+
+    def drain(self):
+        """Yield (metadata, frame) of all buffered frames in order and empty the buffer.
+
+        The frames are views into the pool and only valid until the next append.
+        """
+        while self._frames:
+            offset, n, metadata = self._frames.popleft()
+            yield metadata, self._view[offset:offset + n]
+        self._head = 0
+
+    def clear(self):
+        self._frames.clear()
+        self._head = 0
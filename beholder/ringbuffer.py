@@ -0,0 +1,117 @@
+import threading
+from collections import deque
+
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+BLOCK = 'block'
+OVERFLOW_POLICIES = [DROP_NEWEST, DROP_OLDEST, BLOCK]
+
+
+class FrameRing:
+    """Bounded single producer, single consumer queue of frames.
+
+    Unlike queue.Queue no lock is taken to put or get items, the ring relies on the atomicity of deque.append and
+    deque.popleft. Only a consumer waiting on an empty ring (or with the block policy a producer waiting on a full
+    one) sleeps on an event, which the other side sets only if someone is waiting.
+
+    Overflow policies:
+        drop_newest: discard the item being put
+        drop_oldest: discard the oldest queued item to make room
+        block: wait up to `block_timeout` seconds for room, then discard the item being put
+    """
+
+    def __init__(self, capacity, policy=DROP_NEWEST, block_timeout=1.):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy {}'.format(policy))
+
+        self.capacity = capacity
+        self.policy = policy
+        self.block_timeout = block_timeout
+
+        self._items = deque()
+
+        self._not_empty = threading.Event()
+        self._consumer_waiting = False
+        self._not_full = threading.Event()
+        self._producer_waiting = False
+
+        # Statistics
+        self.n_put = 0
+        self.n_dropped = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def qsize(self):
+        return len(self._items)
+
+    def put(self, item):
+        """Add an item. Returns False if an item had to be dropped.
+        """
+        dropped = False
+        if len(self._items) >= self.capacity:
+            if self.policy == DROP_OLDEST:
+                try:
+                    self._items.popleft()
+                    dropped = True
+                except IndexError:
+                    # Consumer emptied the ring in the meantime
+                    pass
+
+            elif self.policy == BLOCK:
+                self._wait(self._not_full, '_producer_waiting', lambda: len(self._items) < self.capacity,
+                           self.block_timeout)
+                if len(self._items) >= self.capacity:
+                    self.n_dropped += 1
+                    return False
+
+            else:
+                self.n_dropped += 1
+                return False
+
+        self._items.append(item)
+        self.n_put += 1
+        if dropped:
+            self.n_dropped += 1
+
+        n = len(self._items)
+        if n > self.high_water:
+            self.high_water = n
+
+        if self._consumer_waiting:
+            self._not_empty.set()
+
+        return not dropped
+
+    def get_batch(self, max_items, timeout=None):
+        """Remove and return up to `max_items` items, oldest first.
+
+        Waits up to `timeout` seconds for an item if the ring is empty. Returns an empty list on timeout.
+        """
+        if not self._items:
+            self._wait(self._not_empty, '_consumer_waiting', lambda: len(self._items), timeout)
+
+        batch = []
+        try:
+            for _ in range(max_items):
+                batch.append(self._items.popleft())
+        except IndexError:
+            pass
+
+        if batch and self._producer_waiting:
+            self._not_full.set()
+
+        return batch
+
+    def _wait(self, event, waiting_flag, predicate, timeout):
+        # Announce waiting before checking the condition again, so the other side can't miss us
+        event.clear()
+        setattr(self, waiting_flag, True)
+        if not predicate():
+            event.wait(timeout)
+        setattr(self, waiting_flag, False)
+
+    def stats(self):
+        return {'queued': len(self._items), 'high_water': self.high_water, 'dropped': self.n_dropped,
+                'put': self.n_put}
@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import zmq
+
+from beholder.defaults import *
+
+
+class MosaicPublisher(threading.Thread):
+    """Stream the displayed mosaic at reduced size and rate to remote viewers.
+
+    JPEG frames go out on a ZMQ XPUB socket with the MOSAIC_TOPIC, and optionally as multipart MJPEG over HTTP.
+    The display loop offers each rendered mosaic with `submit`, which copies it only if a frame is due and anyone
+    is watching. Resizing and encoding happen in this thread.
+    """
+
+    def __init__(self, ctx, ev_stop, port=MOSAIC_STREAM_PORT, width=MOSAIC_STREAM_WIDTH, fps=MOSAIC_STREAM_FPS,
+                 quality=MOSAIC_STREAM_QUALITY, http_port=None):
+        super().__init__(name='MosaicPublisher', daemon=True)
+        self.zmq_context = ctx
+        self._ev_stop = ev_stop
+        self.port = port
+        self.width = width
+        self.interval = 1 / fps
+        self.quality = quality
+
+        # Mosaic handed over by the display loop
+        self._lock = threading.Lock()
+        self._ev_frame = threading.Event()
+        self._buffer = None
+        self._t_next = 0.
+
+        # Newest encoded frame for the HTTP clients
+        self._cond_jpeg = threading.Condition()
+        self.jpeg = None
+        self.n_frames = 0
+
+        self.n_subscribers = 0
+        # Counted by the handler threads of the HTTP server
+        self._lock_http_clients = threading.Lock()
+        self.n_http_clients = 0
+
+        self.http_server = None
+        if http_port is not None:
+            self.http_server = ThreadingHTTPServer(('', http_port), _mjpeg_handler(self))
+            self.http_server.daemon_threads = True
+            threading.Thread(target=self.http_server.serve_forever, name='MosaicHTTP', daemon=True).start()
+            logging.info('Mosaic stream at http://0.0.0.0:{}/'.format(http_port))
+
+    def watched(self):
+        return self.n_subscribers > 0 or self.n_http_clients > 0
+
+    def submit(self, frame):
+        """Offer a rendered mosaic for streaming.
+        """
+        now = time.monotonic()
+        if now < self._t_next or not self.watched():
+            return
+        self._t_next = now + self.interval
+
+        with self._lock:
+            if self._buffer is None or self._buffer.shape != frame.shape:
+                self._buffer = frame.copy()
+            else:
+                self._buffer[:] = frame
+        self._ev_frame.set()
+
+    def run(self):
+        # The socket belongs to this thread
+        socket = self.zmq_context.socket(zmq.XPUB)
+        if hasattr(zmq, 'XPUB_VERBOSER'):
+            # Pass all subscriptions and unsubscriptions through to count subscribers
+            socket.setsockopt(zmq.XPUB_VERBOSER, 1)
+        socket.bind('tcp://*:{}'.format(self.port))
+        logging.info('Mosaic stream on port {}'.format(self.port))
+
+        while not self._ev_stop.is_set():
+            while socket.poll(0):
+                self.update_subscribers(socket.recv())
+
+            if not self._ev_frame.wait(MOSAIC_STREAM_POLL_INTERVAL):
+                continue
+            self._ev_frame.clear()
+
+            with self._lock:
+                height = round(self._buffer.shape[0] * self.width / self._buffer.shape[1])
+                small = cv2.resize(self._buffer, (self.width, height), interpolation=cv2.INTER_AREA)
+            ok, jpeg = cv2.imencode('.jpg', small, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            if not ok:
+                continue
+
+            jpeg = jpeg.tobytes()
+            if self.n_subscribers:
+                socket.send_multipart([MOSAIC_TOPIC, jpeg])
+            with self._cond_jpeg:
+                self.jpeg = jpeg
+                self.n_frames += 1
+                self._cond_jpeg.notify_all()
+
+        socket.close(linger=0)
+        if self.http_server is not None:
+            self.http_server.shutdown()
+
+    def update_subscribers(self, msg):
+        # First byte 1 for subscriptions, 0 for unsubscriptions, followed by the topic
+        if msg and MOSAIC_TOPIC.startswith(msg[1:]):
+            self.n_subscribers = max(0, self.n_subscribers + (1 if msg[0] else -1))
+            logging.debug('Mosaic stream subscribers: {}'.format(self.n_subscribers))
+
+    def add_http_client(self, n=1):
+        """Count a connecting (n=1) or leaving (n=-1) HTTP client.
+        """
+        with self._lock_http_clients:
+            self.n_http_clients += n
+
+    def wait_jpeg(self, n_frames, timeout):
+        """Wait for a frame newer than frame number `n_frames`. Returns the number and the frame.
+        """
+        with self._cond_jpeg:
+            self._cond_jpeg.wait_for(lambda: self.n_frames > n_frames or self._ev_stop.is_set(), timeout)
+            return self.n_frames, self.jpeg
+
+
+def _mjpeg_handler(publisher):
+    class MJPEGHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+
+            publisher.add_http_client()
+            n_frames = publisher.n_frames
+            try:
+                while not publisher._ev_stop.is_set():
+                    n, jpeg = publisher.wait_jpeg(n_frames, timeout=1.)
+                    if n == n_frames or jpeg is None:
+                        continue
+                    n_frames = n
+                    self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' +
+                                     str(len(jpeg)).encode() + b'\r\n\r\n' + jpeg + b'\r\n')
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                publisher.add_http_client(-1)
+
+        def log_message(self, format, *args):
+            logging.debug('Mosaic HTTP {}: {}'.format(self.address_string(), format % args))
+
+    return MJPEGHandler
@@ -0,0 +1,81 @@
+import csv
+import logging
+
+import numpy as np
+
+from beholder.defaults import *
+from beholder.metadata import (METADATA_DTYPE, METADATA_MISSING, CsvMetadataLog, BinaryMetadataLog, load_metadata,
+                               metadata_to_csv)
+
+
+def frame_metadata(n):
+    return {'name': 'eye01', 'frame_index': n, 'frame_gpu_ts': 1000 * n, 'callback_gpu_ts': 1000 * n + 10,
+            'callback_clock_ts': 1.5e9 + n / 30, 'recv_clock_ts': 1.5e9 + n / 30 + 0.01, 'bytes': 50000 + n}
+
+
+def write_binary(path, metadata):
+    log = BinaryMetadataLog(path)
+    log.write(metadata)
+    log.close()
+
+
+def test_binary_round_trip(tmp_path):
+    # More than one batch, and a frame of an eye sending the deprecated format without metadata
+    metadata = [frame_metadata(n) for n in range(METADATA_BATCH_SIZE + 5)]
+    metadata.append({'frame_index': 7, 'recv_clock_ts': 1.6e9, 'bytes': 100})
+    path = tmp_path / 'eye01.metab'
+    write_binary(path, metadata)
+
+    records = load_metadata(path)
+    assert len(records) == len(metadata)
+    assert records[3]['name'] == b'eye01'
+    assert records[3]['frame_index'] == 3
+    assert records[3]['callback_clock_ts'] == metadata[3]['callback_clock_ts']
+    assert np.array_equal(records['bytes'][:-1], [md['bytes'] for md in metadata[:-1]])
+
+    missing = records[-1]
+    assert missing['frame_index'] == 7
+    assert missing['frame_gpu_ts'] == METADATA_MISSING['frame_gpu_ts']
+    assert np.isnan(missing['callback_clock_ts'])
+
+
+def test_empty_file(tmp_path):
+    path = tmp_path / 'empty.metab'
+    write_binary(path, [])
+    assert len(load_metadata(path)) == 0
+
+
+def test_truncated_file(tmp_path, caplog):
+    path = tmp_path / 'eye01.metab'
+    write_binary(path, [frame_metadata(n) for n in range(10)])
+    with open(path, 'r+b') as f:
+        f.truncate(9 * METADATA_DTYPE.itemsize + 5)
+
+    with caplog.at_level(logging.WARNING):
+        records = load_metadata(path)
+    assert len(records) == 9
+    assert records[-1]['frame_index'] == 8
+    assert 'partial record' in caplog.text
+
+
+def test_binary_to_csv(tmp_path):
+    metadata = [frame_metadata(n) for n in range(3)]
+    binary_path = tmp_path / 'eye01.metab'
+    write_binary(binary_path, metadata)
+
+    csv_log = CsvMetadataLog(tmp_path / 'direct.meta')
+    csv_log.write(metadata)
+    csv_log.close()
+
+    with open(metadata_to_csv(binary_path), newline='') as converted, open(csv_log.path, newline='') as direct:
+        rows_converted, rows_direct = list(csv.reader(converted)), list(csv.reader(direct))
+
+    assert rows_converted[0] == rows_direct[0] == list(METADATA_DTYPE.names)
+    for row_converted, row_direct in zip(rows_converted[1:], rows_direct[1:]):
+        assert row_converted[0] == row_direct[0]
+        assert list(map(number, row_converted[1:])) == list(map(number, row_direct[1:]))
+
+
+def number(value):
+    # Fields missing in the csv log are empty, NaN in the binary records
+    return None if value in ('', 'nan') else float(value)
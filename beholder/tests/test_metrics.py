@@ -0,0 +1,84 @@
+import socket
+import threading
+
+import pytest
+
+from beholder.metrics import Histogram, Metrics, _packets
+
+
+def parse_line(line):
+    """Measurement, tags, fields and timestamp of a line of line protocol without escaped characters.
+    """
+    key, fields, ts = line.split(' ')
+    measurement, *tags = key.split(',')
+    return (measurement, dict(tag.split('=') for tag in tags), dict(field.split('=') for field in fields.split(',')),
+            int(ts))
+
+
+@pytest.fixture
+def receiver():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(5)
+    yield sock
+    sock.close()
+
+
+def receive_lines(sock):
+    return sock.recv(65536).decode().splitlines()
+
+
+def test_udp_flush(receiver):
+    metrics = Metrics('udp://127.0.0.1:{}'.format(receiver.getsockname()[1]), threading.Event())
+    histogram = Histogram([1, 10, 100])
+    n_frames = [0]
+    metrics.add('beholder_frames', {'source': '01'}, {'received': lambda: n_frames[0], 'recording': lambda: True,
+                                                      'latency': histogram})
+
+    n_frames[0] = 42
+    for value in [0.5, 5, 5, 50, 250]:
+        histogram.observe(value)
+    metrics.flush()
+
+    (line,) = receive_lines(receiver)
+    measurement, tags, fields, ts = parse_line(line)
+    assert measurement == 'beholder_frames'
+    assert tags == {'host': socket.gethostname(), 'source': '01'}
+    assert ts > 0
+    assert fields['received'] == '42i'
+    assert fields['recording'] == 'true'
+    assert fields['latency_count'] == '5i'
+    assert float(fields['latency_sum']) == 310.5
+    assert float(fields['latency_max']) == 250
+    assert [fields['latency_le_{}'.format(bound)] for bound in [1, 10, 100]] == ['1i', '3i', '4i']
+    assert float(fields['latency_p50']) == 10
+    # Above all buckets, the largest value observed
+    assert float(fields['latency_p99']) == 250
+
+    # Percentiles and maximum only cover values observed since the last flush
+    histogram.observe(2)
+    metrics.flush()
+    _, _, fields, _ = parse_line(receive_lines(receiver)[0])
+    assert fields['latency_count'] == '6i'
+    assert float(fields['latency_max']) == 2
+    assert float(fields['latency_p50']) == float(fields['latency_p99']) == 10
+
+    # Above all buckets, the largest value of this interval rather than the earlier 250
+    histogram.observe(120)
+    histogram.observe(150)
+    metrics.flush()
+    _, _, fields, _ = parse_line(receive_lines(receiver)[0])
+    assert float(fields['latency_max']) == 150
+    assert float(fields['latency_p99']) == 150
+
+    # No values, no maximum
+    metrics.flush()
+    _, _, fields, _ = parse_line(receive_lines(receiver)[0])
+    assert 'latency_max' not in fields and 'latency_p99' not in fields
+
+
+def test_packets():
+    lines = ['x' * 600] * 5
+    payloads = list(_packets(lines, 1400))
+    assert [len(payload) for payload in payloads] == [1202, 1202, 601]
+    assert b''.join(payloads).decode().splitlines() == lines
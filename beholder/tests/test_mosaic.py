@@ -0,0 +1,136 @@
+import uuid
+from multiprocessing import resource_tracker
+
+import numpy as np
+import pytest
+
+from beholder.mosaic import SharedMosaic, MosaicReader
+
+TILE_HEIGHT, TILE_WIDTH = 6, 8
+
+
+def make_cfg(n_rows=2, n_cols=2):
+    return {'shared_shape': (TILE_HEIGHT * n_rows, TILE_WIDTH * n_cols, 3), 'n_cols': n_cols,
+            'cropped_frame_height': TILE_HEIGHT, 'cropped_frame_width': TILE_WIDTH, 'frame_crop_x': 0,
+            'frame_crop_y': 0, 'preview_scale': 1}
+
+
+def source_frame(value):
+    return np.full((TILE_HEIGHT, TILE_WIDTH, 3), value, dtype=np.uint8)
+
+
+class Lapping(np.ndarray):
+    """Display frame during whose copy the writer of a tile updates it `n_updates` times.
+    """
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.mosaic.gen[self.idx] += self.n_updates
+
+
+def lapping(mosaic, idx, n_updates):
+    out = np.zeros(mosaic.shape, dtype=np.uint8).view(Lapping)
+    out.mosaic, out.idx, out.n_updates = mosaic, idx, n_updates
+    return out
+
+
+@pytest.fixture
+def exported():
+    name = 'beholder_test_{}'.format(uuid.uuid4().hex[:8])
+    mosaic = SharedMosaic(make_cfg(), 4, name=name)
+    yield name, mosaic
+    mosaic.close()
+
+
+def open_reader(name):
+    reader = MosaicReader(name)
+    # Reader and exporter share the resource tracker of this process, keep the exporter's registration
+    resource_tracker.register('/' + reader.shm.name, 'shared_memory')
+    return reader
+
+
+def test_update_and_read():
+    mosaic = SharedMosaic(make_cfg(), 4)
+    out = np.zeros(mosaic.shape, dtype=np.uint8)
+    assert mosaic.changed(np.zeros(4, dtype=np.uint64)).tolist() == []
+    assert np.isinf(mosaic.age()).all()
+
+    for gen in range(1, 5):
+        mosaic.update(1, source_frame(gen), frame_index=gen, timestamp=1000. + gen)
+        assert mosaic.read(1, out) == gen
+        assert (out[:TILE_HEIGHT, TILE_WIDTH:] == gen).all()
+
+    assert (out[:TILE_HEIGHT, :TILE_WIDTH] == 0).all()
+    assert mosaic.changed(np.zeros(4, dtype=np.uint64)).tolist() == [1]
+    assert mosaic.frame_index[4 % mosaic.n_buffers, 1] == 4
+    assert np.isfinite(mosaic.age()).tolist() == [False, True, False, False]
+
+
+def test_read_with_concurrent_update():
+    mosaic = SharedMosaic(make_cfg(), 4)
+    mosaic.update(2, source_frame(7))
+    # One update during the copy goes into another buffer
+    assert mosaic.read(2, lapping(mosaic, 2, 1)) == 1
+
+
+def test_read_lapped_by_writer():
+    mosaic = SharedMosaic(make_cfg(), 4)
+    mosaic.update(2, source_frame(7))
+    # The writer may have reached the buffer being copied on every try
+    assert mosaic.read(2, lapping(mosaic, 2, mosaic.n_buffers - 1)) is None
+
+
+def test_reader(exported):
+    name, mosaic = exported
+    mosaic.update(3, source_frame(9), frame_index=42, timestamp=1234.5)
+
+    reader = open_reader(name)
+    assert reader.shape == mosaic.shape
+    assert (reader.n_tiles, reader.n_buffers, reader.n_cols) == (4, mosaic.n_buffers, 2)
+    assert (reader.tile_height, reader.tile_width) == (TILE_HEIGHT, TILE_WIDTH)
+
+    view, gen, frame_index, timestamp = reader.tile(3)
+    assert (gen, frame_index, timestamp) == (1, 42, 1234.5)
+    assert (view == 9).all()
+
+    # The view stays valid until the writer may reach its buffer
+    mosaic.update(3, source_frame(10))
+    assert reader.valid(3, gen)
+    mosaic.update(3, source_frame(11))
+    assert not reader.valid(3, gen)
+    del view
+
+    tile, gen, frame_index, timestamp = reader.read(3)
+    assert gen == 3 and frame_index == -1 and np.isnan(timestamp)
+    assert (tile == 11).all()
+    assert np.isfinite(reader.age()).tolist() == [False, False, False, True]
+    reader.close()
+
+
+def test_reader_rejects_other_memory():
+    from multiprocessing.shared_memory import SharedMemory
+    name = 'beholder_test_{}'.format(uuid.uuid4().hex[:8])
+    shm = SharedMemory(name, create=True, size=256)
+    try:
+        with pytest.raises(ValueError):
+            open_reader(name)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def test_closed_mosaic_stays_readable(exported):
+    name, mosaic = exported
+    mosaic.update(0, source_frame(5), frame_index=1)
+    reader = open_reader(name)
+    mosaic.close()
+
+    # Last state for the exporter, the mapping for readers still attached
+    out = np.zeros(mosaic.shape, dtype=np.uint8)
+    assert mosaic.read(0, out) == 1
+    assert (out[:TILE_HEIGHT, :TILE_WIDTH] == 5).all()
+    assert np.isfinite(mosaic.age()[0])
+
+    tile, gen, _, _ = reader.read(0)
+    assert gen == 1 and (tile == 5).all()
+    reader.close()
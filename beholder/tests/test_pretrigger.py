@@ -0,0 +1,61 @@
+from beholder.pretrigger import PreTriggerBuffer
+
+
+def frame(n, t, size=10):
+    return {'frame_index': n, 'recv_clock_ts': t}, bytes([n]) * size
+
+
+def drained(buffer):
+    return [(metadata['frame_index'], bytes(data)) for metadata, data in buffer.drain()]
+
+
+def test_drain_order():
+    buffer = PreTriggerBuffer(duration=10, pool_size=100)
+    for n in range(5):
+        buffer.append(*frame(n, n / 10))
+    assert len(buffer) == 5
+    assert drained(buffer) == [(n, bytes([n]) * 10) for n in range(5)]
+    assert len(buffer) == 0 and drained(buffer) == []
+
+
+def test_wraparound_evicts_overwritten_frames():
+    # Room for three frames of 30 bytes, the fourth wraps around and overwrites the first
+    buffer = PreTriggerBuffer(duration=10, pool_size=100)
+    for n in range(4):
+        buffer.append(*frame(n, n / 10, size=30))
+    assert drained(buffer) == [(n, bytes([n]) * 30) for n in range(1, 4)]
+
+
+def test_wraparound_drops_frames_behind_head():
+    # Frames between the write position and the end of the pool are dropped when wrapping around
+    buffer = PreTriggerBuffer(duration=10, pool_size=100)
+    buffer.append(*frame(0, 0., size=50))  # [0, 50)
+    buffer.append(*frame(1, .1, size=40))  # [50, 90)
+    buffer.append(*frame(2, .2, size=30))  # wraps to [0, 30), overwrites frame 0
+    buffer.append(*frame(3, .3, size=15))  # [30, 45)
+    buffer.append(*frame(4, .4, size=60))  # wraps past frame 1 at [50, 90) to [0, 60), overwrites frames 2 and 3
+    assert drained(buffer) == [(4, bytes([4]) * 60)]
+
+
+def test_eviction_by_duration():
+    buffer = PreTriggerBuffer(duration=1., pool_size=1000)
+    for n in range(30):
+        buffer.append(*frame(n, n / 10))
+    # Frames at most one second older than the newest, at t=2.9
+    assert [n for n, _ in drained(buffer)] == list(range(19, 30))
+
+
+def test_frame_larger_than_pool():
+    buffer = PreTriggerBuffer(duration=10, pool_size=100)
+    buffer.append(*frame(0, 0.))
+    buffer.append(*frame(1, .1, size=101))
+    assert [n for n, _ in drained(buffer)] == [0]
+
+
+def test_drain_resets_head():
+    buffer = PreTriggerBuffer(duration=10, pool_size=100)
+    buffer.append(*frame(0, 0., size=60))
+    drained(buffer)
+    buffer.append(*frame(1, 1., size=60))
+    buffer.append(*frame(2, 1.1, size=40))
+    assert drained(buffer) == [(1, bytes([1]) * 60), (2, bytes([2]) * 40)]
@@ -0,0 +1,75 @@
+import threading
+import time
+
+import pytest
+
+from beholder.ringbuffer import FrameRing, DROP_NEWEST, DROP_OLDEST, BLOCK
+
+
+def filled(policy, capacity=3, **kwargs):
+    ring = FrameRing(capacity, policy=policy, **kwargs)
+    for n in range(capacity):
+        assert ring.put(n)
+    return ring
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        FrameRing(3, policy='drop_random')
+
+
+def test_fifo_batches():
+    ring = filled(DROP_NEWEST, capacity=5)
+    assert ring.get_batch(2) == [0, 1]
+    assert ring.get_batch(10) == [2, 3, 4]
+    assert ring.get_batch(10, timeout=0.01) == []
+
+
+def test_drop_newest():
+    ring = filled(DROP_NEWEST)
+    assert not ring.put(3)
+    assert ring.get_batch(10) == [0, 1, 2]
+    assert ring.stats() == {'queued': 0, 'high_water': 3, 'dropped': 1, 'put': 3}
+
+
+def test_drop_oldest():
+    ring = filled(DROP_OLDEST)
+    assert not ring.put(3)
+    assert not ring.put(4)
+    assert ring.get_batch(10) == [2, 3, 4]
+    assert ring.stats() == {'queued': 0, 'high_water': 3, 'dropped': 2, 'put': 5}
+
+
+def test_block_times_out():
+    ring = filled(BLOCK, block_timeout=0.05)
+    t0 = time.monotonic()
+    assert not ring.put(3)
+    assert time.monotonic() - t0 >= 0.04
+    assert ring.get_batch(10) == [0, 1, 2]
+    assert ring.n_dropped == 1
+
+
+def test_block_waits_for_consumer():
+    ring = filled(BLOCK, block_timeout=5.)
+    consumed = []
+
+    def consume():
+        time.sleep(0.05)
+        consumed.extend(ring.get_batch(1))
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    t0 = time.monotonic()
+    assert ring.put(3)
+    assert time.monotonic() - t0 < 4
+    consumer.join()
+
+    assert consumed == [0]
+    assert ring.get_batch(10) == [1, 2, 3]
+    assert ring.n_dropped == 0
+
+
+def test_consumer_wakes_on_put():
+    ring = FrameRing(3)
+    threading.Timer(0.05, ring.put, args=('frame',)).start()
+    assert ring.get_batch(10, timeout=5.) == ['frame']
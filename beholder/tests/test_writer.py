@@ -0,0 +1,266 @@
+import csv
+import os
+import threading
+import time
+
+import pytest
+
+from beholder.ringbuffer import FrameRing
+from beholder import writer as writer_module
+from beholder.encoders import ENCODERS, WarmEncoder
+from beholder.mover import Mover
+from beholder.writer import Writer
+from beholder.defaults import *
+
+RECORDING_TS = '2020-01-01_12-00-00'
+
+
+class Parent:
+    def __init__(self, recording_path):
+        self.recording_path = recording_path
+        self.recording_ts = RECORDING_TS
+        self._first_segment_key = None
+
+    def first_segment_key(self, key):
+        if self._first_segment_key is None:
+            self._first_segment_key = key
+        return self._first_segment_key
+
+
+def make_cfg(out_path, **cfg):
+    defaults = dict(encoder='raw', metadata_format='csv', segment_length=0, segment_frames=0, spool_path=None,
+                    warm_encoders=False, pretrigger=0, out_path=out_path, frame_fps=10)
+    defaults.update(cfg)
+    return defaults
+
+
+def make_writer(tmp_path, mover=None, parent=None, idx=0, **cfg):
+    recording_path = tmp_path / 'out' / RECORDING_TS
+    recording_path.mkdir(parents=True, exist_ok=True)
+    cfg = make_cfg(tmp_path / 'out', **cfg)
+    events = [threading.Event() for _ in range(3)]
+    parent = Parent(recording_path) if parent is None else parent
+    return Writer(cfg, FrameRing(WRITE_QUEUE_LENGTH), *events, main_thread=parent, idx=idx, mover=mover)
+
+
+def frame(n, t):
+    return [{'name': 'eye01', 'frame_index': n, 'frame_gpu_ts': n, 'callback_gpu_ts': n, 'callback_clock_ts': t,
+             'recv_clock_ts': t + 0.01, 'bytes': 16}, bytes([n % 256]) * 16]
+
+
+def record(writer, frames, batch_size=3):
+    writer.start_recording(frames[0][0])
+    for n in range(0, len(frames), batch_size):
+        writer.write_frames(frames[n:n + batch_size])
+    writer.stop_recording()
+    for finalizer in writer._finalizers:
+        finalizer.join()
+
+
+def manifest(path):
+    with open(path / MANIFEST_NAME, newline='') as f:
+        return sorted(csv.DictReader(f), key=lambda entry: int(entry['segment'] or 0))
+
+
+def test_single_file(tmp_path):
+    writer = make_writer(tmp_path)
+    record(writer, [frame(n, 1000. + n / 10) for n in range(10)])
+
+    entries = manifest(writer.recording_path)
+    assert [(e['segment'], e['n_frames']) for e in entries] == [('', '10')]
+    assert (writer.recording_path / 'eye01_{}.mjpeg'.format(RECORDING_TS)).stat().st_size == 160
+
+
+@pytest.mark.parametrize('t_start', [1000.35, 1000.95])
+def test_time_segments(tmp_path, t_start):
+    # Boundaries at whole seconds of the eye's clock, the first segment is cut short
+    writer = make_writer(tmp_path, segment_length=1)
+    frames = [frame(n, t_start + n / 10) for n in range(25)]
+    record(writer, frames)
+
+    entries = manifest(writer.recording_path)
+    assert [int(e['segment']) for e in entries] == list(range(len(entries)))
+    assert sum(int(e['n_frames']) for e in entries) == len(frames)
+    for e in entries:
+        assert int(float(e['t_start'])) == int(float(e['t_end'])) == int(t_start) + int(e['segment'])
+    assert int(entries[0]['first_frame']) == 0
+
+
+def test_segments_aligned_across_writers(tmp_path):
+    # The first frames of the eyes fall on either side of a boundary, segment numbers still cover the same time
+    first = make_writer(tmp_path, segment_length=60)
+    second = make_writer(tmp_path, parent=first.parent, idx=1, segment_length=60)
+    record(first, [frame(0, 1079.98), frame(1, 1100.)])
+    record(second, [frame(0, 1080.02), frame(1, 1100.)])
+
+    entries = manifest(first.recording_path)
+    assert sorted((e['eye'], e['segment'], e['n_frames']) for e in entries) == [
+        ('1', '0', '1'), ('1', '1', '1'), ('2', '1', '2')]
+    assert (first.recording_path / 'eye02_{}_001.mjpeg'.format(RECORDING_TS)).exists()
+
+
+def test_frame_segments(tmp_path):
+    writer = make_writer(tmp_path, segment_frames=4)
+    record(writer, [frame(n, 1000. + n / 10) for n in range(10)])
+
+    entries = manifest(writer.recording_path)
+    assert [(e['segment'], e['n_frames'], e['first_frame']) for e in entries] == [
+        ('0', '4', '0'), ('1', '4', '4'), ('2', '2', '8')]
+    assert (writer.recording_path / 'eye01_{}_002.mjpeg'.format(RECORDING_TS)).stat().st_size == 2 * 16
+
+
+def failing_writev(monkeypatch, n_bytes):
+    """Let the encoder take `n_bytes` before its pipe breaks, once.
+    """
+    writev = os.writev
+    budget = [n_bytes]
+
+    def fake_writev(fd, buffers):
+        if budget[0] is None:
+            return writev(fd, buffers)
+        if budget[0] == 0:
+            budget[0] = None
+            raise BrokenPipeError
+        n = writev(fd, [memoryview(b''.join(buffers))[:budget[0]]])
+        budget[0] -= n
+        return n
+
+    monkeypatch.setattr(os, 'writev', fake_writev)
+
+
+def test_partial_batch_not_duplicated(tmp_path, monkeypatch):
+    # Encoder fails in the middle of the third frame of the first batch
+    failing_writev(monkeypatch, 2 * 16 + 5)
+    writer = make_writer(tmp_path)
+    record(writer, [frame(n, 1000. + n / 10) for n in range(10)], batch_size=4)
+
+    entries = manifest(writer.recording_path)
+    assert [(e['part'], e['n_frames'], e['first_frame']) for e in sorted(entries, key=lambda e: e['part'])] == [
+        ('0', '2', '0'), ('1', '8', '2')]
+    assert writer.n_frames == 10
+
+    with open(writer.recording_path / 'eye01_{}_part01.meta'.format(RECORDING_TS), newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [row['frame_index'] for row in rows] == [str(n) for n in range(2, 10)]
+    assert float(rows[0]['downtime']) >= 0
+    assert all(row['downtime'] == '' for row in rows[1:])
+
+
+def test_encoder_start_failure_counts_as_restart(tmp_path, monkeypatch):
+    failing_writev(monkeypatch, 0)
+    raw = ENCODERS['raw']
+    open_encoder = raw.open
+    failures = [1]
+
+    def flaky_open(out_path, low_bitrate=False):
+        if 'part' in out_path.name and failures[0]:
+            failures[0] -= 1
+            raise OSError('Too many open files')
+        return open_encoder(out_path, low_bitrate)
+
+    monkeypatch.setattr(raw, 'open', flaky_open)
+    writer = make_writer(tmp_path)
+    writer.start_recording(frame(0, 1000.)[0])
+    writer.write_frames([frame(n, 1000. + n / 10) for n in range(3)])
+
+    assert writer.recording
+    assert writer.n_restarts == 2
+    assert writer.segment.part == 2
+    assert writer.segment.n_frames == 3
+    writer.stop_recording()
+
+
+def test_spool_migration_on_shutdown(tmp_path):
+    spool_path = tmp_path / 'spool'
+    queue = FrameRing(WRITE_QUEUE_LENGTH)
+    mover = Mover([queue], max_rate=0)
+    mover.start()
+
+    recording_path = tmp_path / 'out' / RECORDING_TS
+    recording_path.mkdir(parents=True)
+    ev_stop, ev_recording, ev_trial = (threading.Event() for _ in range(3))
+    writer = Writer(make_cfg(tmp_path / 'out', spool_path=spool_path), queue, ev_stop, ev_recording, ev_trial,
+                    main_thread=Parent(recording_path), mover=mover)
+    writer.start()
+
+    ev_recording.set()
+    for n in range(20):
+        queue.put(frame(n, 1000. + n / 10))
+    t0 = time.monotonic()
+    while writer.n_frames < 20 and time.monotonic() - t0 < 5:
+        time.sleep(0.01)
+
+    # Shut down while recording, as Beholder.stop does
+    ev_stop.set()
+    writer.join()
+    mover.finish()
+
+    video = recording_path / 'eye01_{}.mjpeg'.format(RECORDING_TS)
+    assert video.stat().st_size == 20 * 16
+    assert video.with_suffix('.meta').exists()
+    entries = manifest(recording_path)
+    assert [(e['n_frames'], e['video']) for e in entries] == [('20', video.name)]
+    assert entries[0]['sha256']
+    assert not (spool_path / RECORDING_TS).exists()
+
+
+def test_warm_encoder_discarded_on_shutdown(tmp_path, monkeypatch):
+    class SlowWarmEncoder(WarmEncoder):
+        def __init__(self, *args, **kwargs):
+            # Longer than the Writer takes to notice the stop
+            time.sleep(0.8)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(writer_module, 'WarmEncoder', SlowWarmEncoder)
+    writer = make_writer(tmp_path, warm_encoders=True)
+    writer.start()
+    # Shut down while the warm encoder is still being started
+    time.sleep(0.05)
+    writer._ev_stop.set()
+    writer.join()
+
+    # Nothing left behind once the start would have finished
+    time.sleep(0.8)
+    assert writer.warm is None
+    assert list((tmp_path / 'out' / WARM_DIR).iterdir()) == []
+
+
+def test_records_again_after_giving_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(writer_module, 'ENCODER_MAX_RESTARTS', 0)
+    failing_writev(monkeypatch, 0)
+    writer = make_writer(tmp_path)
+    queue, ev_recording = writer.in_queue, writer._ev_recording
+    writer.start()
+
+    def session(recording_path, first):
+        recording_path.mkdir(parents=True, exist_ok=True)
+        writer.parent.recording_path = recording_path
+        ev_recording.set()
+        for n in range(first, first + 5):
+            queue.put(frame(n, 1000. + n / 10))
+        wait_for(lambda: not len(queue))
+        ev_recording.clear()
+        # Frames in between sessions
+        queue.put(frame(first + 5, 1000.))
+        wait_for(lambda: not len(queue))
+
+    # The encoder of the first session fails, the Writer gives up
+    first_path = writer.parent.recording_path
+    session(first_path, 0)
+    assert not writer.recording and writer.segment is None
+
+    second_path = tmp_path / 'out' / 'second'
+    session(second_path, 10)
+    writer._ev_stop.set()
+    writer.join()
+
+    assert manifest(first_path)[0]['n_frames'] == '0'
+    assert [(e['n_frames'], e['first_frame']) for e in manifest(second_path)] == [('5', '10')]
+
+
+def wait_for(condition, timeout=5.):
+    t0 = time.monotonic()
+    while not condition() and time.monotonic() - t0 < timeout:
+        time.sleep(0.01)
+    # Let the Writer finish the batch it took
+    time.sleep(0.1)
@@ -1,7 +1,14 @@
 from math import sqrt
 
+import cv2
 import numpy as np
 
+# Decode flags for reduced resolution (libjpeg DCT scaling) decoding of preview frames
+PREVIEW_IMREAD_FLAGS = {1: cv2.IMREAD_UNCHANGED,
+                        2: cv2.IMREAD_REDUCED_COLOR_2,
+                        4: cv2.IMREAD_REDUCED_COLOR_4,
+                        8: cv2.IMREAD_REDUCED_COLOR_8}
+
 
 def fmt_time(t):
     """Format a number of seconds into a human readable time string of HH:MM:SS.FFF
@@ -21,3 +28,21 @@ def euclidean_distance(p1, p2):
     """Calculate the euclidean distance between two points.
     """
     return sqrt((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2)
+
+
+def tile_slices(cfg, idx):
+    """Return the slices of the shared mosaic tile of source `idx` and of the crop of its (flipped) preview frame.
+    """
+    n_row, n_col = divmod(idx, cfg['n_cols'])
+    crop_w = cfg['cropped_frame_width']
+    crop_h = cfg['cropped_frame_height']
+    crop_x = cfg['frame_crop_x'] // cfg['preview_scale']
+    crop_y = cfg['frame_crop_y'] // cfg['preview_scale']
+
+    # First row is cropped at the bottom, all others at the top edge of the frame
+    fc_lim_M = (crop_y, crop_y + crop_h) if n_row else (0, crop_h)
+    fc_lim_N = (crop_x, crop_x + crop_w)
+
+    tile = (slice(crop_h * n_row, crop_h * (n_row + 1)), slice(crop_w * n_col, crop_w * (n_col + 1)))
+    crop = (slice(*fc_lim_M), slice(*fc_lim_N))
+    return tile, crop
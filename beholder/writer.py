@@ -1,28 +1,183 @@
 import csv
 import logging
-import subprocess as sp
+import math
 import threading
-from queue import Empty
+import time
 
 import numpy as np
 
 from beholder.defaults import *
+from beholder.encoders import ENCODERS, PipeWriter, WarmEncoder
+from beholder.metadata import METADATA_LOGS
+from beholder.metrics import Histogram
+from beholder.pretrigger import PreTriggerBuffer
+
+
+MANIFEST_FIELDS = ['eye', 'segment', 'part', 'video', 'metadata', 'n_frames', 'first_frame', 'last_frame', 't_start',
+                   't_end', 'returncode', 'downtime', 'error', 'sha256', 'metadata_sha256']
+_manifest_lock = threading.Lock()
+
+
+def append_manifest(path, entry):
+    """Append an entry of a finished segment to the manifest csv file of a recording.
+    """
+    with _manifest_lock:
+        new = not path.exists()
+        with open(path, 'a', newline='') as manifest:
+            writer = csv.DictWriter(manifest, fieldnames=MANIFEST_FIELDS)
+            if new:
+                writer.writeheader()
+            writer.writerow(entry)
+
+
+class Segment:
+    """A video file being encoded together with its frame metadata log.
+    """
+
+    def __init__(self, idx, recording_path, recording_ts, encoder, meta_log, index=None, part=0, warm=None,
+                 low_bitrate=False, mover=None, final_path=None):
+        self.id = idx
+        self.index = index
+        self.part = part
+
+        # With a spool, the finished segment is handed to the mover for migration to final_path
+        self.mover = mover
+        self.final_path = final_path
+
+        name = 'eye{:02d}_{}'.format(idx + 1, recording_ts)
+        if index is not None:
+            name += '_{:03d}'.format(index)
+        # Further parts replace a failed encoder
+        if part:
+            name += '_part{:02d}'.format(part)
+        self.path = recording_path / (name + encoder.suffix)
+
+        # A warm encoder writes to its temporary file, moved to the segment path once encoding has finished
+        if warm is None:
+            self.proc = encoder.open(self.path, low_bitrate)
+            self._warm_path = None
+        else:
+            self.proc = warm.proc
+            self._warm_path = warm.path
+        self.pipe = PipeWriter(self.proc.stdin)
+        self.meta_log = meta_log(self.path.with_suffix(meta_log.suffix))
+
+        self.n_frames = 0
+        # Frames of the last write taken by the encoder
+        self.n_accepted = 0
+        self.first_frame = None
+        self.last_frame = None
+        self.t_start = None
+        self.t_end = None
+
+        # Start of the write in progress, watched for stalled encoders
+        self.t_write = None
+        self.stalled = False
+        self.t_stalled = None
+
+        # Failure of the encoder of the previous part and seconds until this part took over
+        self.t_failure = None
+        self.downtime = None
+        self.error = None
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def write(self, batch):
+        """Write a batch of (metadata, frame) pairs. Raises BrokenPipeError if the encoder is gone.
+
+        The frames the encoder took in full, also before failing, are logged and counted in `n_accepted`.
+        """
+        self.t_write = time.monotonic()
+        try:
+            self.pipe.writelines(frame for _, frame in batch)
+        finally:
+            self.t_write = None
+            self.n_accepted = self.pipe.n_complete
+            if self.n_accepted:
+                self._accepted(batch[:self.n_accepted])
+
+    def _accepted(self, batch):
+        # The first frame after an encoder failure carries the gap in its metadata
+        if self.t_failure is not None and self.downtime is None:
+            self.downtime = time.monotonic() - self.t_failure
+            batch[0][0]['downtime'] = self.downtime
+
+        self.meta_log.write(metadata for metadata, _ in batch)
+
+        if self.first_frame is None:
+            self.first_frame = batch[0][0]['frame_index']
+            self.t_start = frame_time(batch[0][0])
+        self.last_frame = batch[-1][0]['frame_index']
+        self.t_end = frame_time(batch[-1][0])
+        self.n_frames += len(batch)
+
+    def close(self):
+        """Finish encoding and add the segment to the manifest of the recording.
+        """
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = self.proc.wait()
+        self.meta_log.close()
+
+        if self._warm_path is not None and self._warm_path.exists():
+            self._warm_path.replace(self.path)
+
+        entry = {'eye': self.id + 1, 'segment': self.index, 'part': self.part, 'video': self.path.name,
+                 'metadata': self.meta_log.path.name, 'n_frames': self.n_frames, 'first_frame': self.first_frame,
+                 'last_frame': self.last_frame, 't_start': self.t_start, 't_end': self.t_end,
+                 'returncode': returncode, 'downtime': self.downtime, 'error': self.error}
+        if self.mover is None:
+            append_manifest(self.path.parent / MANIFEST_NAME, entry)
+        else:
+            self.mover.submit({'sha256': self.path, 'metadata_sha256': self.meta_log.path}, self.final_path, entry)
+        return returncode
+
+
+def frame_time(metadata):
+    """Capture time of a frame on the eye's clock, falling back on the time of reception.
+    """
+    t = metadata['callback_clock_ts']
+    return metadata['recv_clock_ts'] if t is None else float(t)
 
 
 class Writer(threading.Thread):
-    def __init__(self, cfg, in_queue, ev_alive, ev_recording, ev_trial_active, main_thread, idx=0):
+    def __init__(self, cfg, in_queue, ev_alive, ev_recording, ev_trial_active, main_thread, idx=0, mover=None):
         super().__init__()
         self.id = idx
         self.cfg = cfg
 
         self.name = 'Writer #{:02d}'.format(self.id)
-        self.writer_pipe = None
-        self.log_file = None
-        self.log_csv = None
-        self.log_csv_header_written = False
+        self.segment = None
         self.logger = None
 
+        self.recording_path = None
+        self.recording_ts = None
+
+        # Record into the spool directory, the mover migrates finished segments to the recording path of the parent
+        self.spool_path = cfg['spool_path']
+        self.mover = mover
+        self.final_path = None
+        self._finalizers = []
+
+        # Length of segments in seconds, aligned to multiples of the length on the eyes' clock for all Writers, or in
+        # frames counted by each Writer
+        self.segment_length = cfg['segment_length']
+        self.segment_frames = cfg['segment_frames']
+        self._first_segment_key = None
+        self._n_segment_frames = 0
+
+        # Frames and bytes handed to the encoders
         self.n_frames = 0
+        self.n_bytes_written = 0
+        # Seconds spent blocked writing to the encoders, as opposed to waiting for frames
+        self.t_blocked = 0.
+        self.write_latency = Histogram()  # ms per batch handed to the encoder
+
+        # Start new encoders at lower bitrate, set by the DiskMonitor
+        self.low_bitrate = False
 
         self.width = None
         self.height = None
@@ -33,33 +188,218 @@ class Writer(threading.Thread):
         self._ev_recording = ev_recording
         self._ev_trial_active = ev_trial_active
         self.n_retry = 0
+        self.n_restarts = 0
 
         self.parent = main_thread
 
+        # Frames of the last seconds before recording starts
+        self.pretrigger = None
+        if cfg['pretrigger']:
+            pool_size = int(cfg['pretrigger'] * cfg['frame_fps'] * PRETRIGGER_FRAME_BYTES)
+            self.pretrigger = PreTriggerBuffer(cfg['pretrigger'], pool_size)
+
+        # Encoder started ahead of the next segment, by the thread _warmer
+        self.warm = None
+        self._warmer = None
+
         self.recording = False
         logging.debug('Writer initialization done!')
 
-    def start_recording(self):
+    def start_recording(self, metadata):
+        """Start recording with the frame of `metadata`, its capture time determines the first segment.
+        """
         # Video output object
         logging.debug('Starting Recording in {}'.format(self.parent.recording_path))
 
-        out_path = self.parent.recording_path / 'eye{:02d}_{}.mp4'.format(self.id + 1, self.parent.recording_ts)
-        ffmpeg_cmd = FFMPEG_COMMAND + [str(out_path)]
-        logging.debug(' '.join(ffmpeg_cmd))
+        self.recording_path = self.parent.recording_path
+        self.recording_ts = self.parent.recording_ts
+        self.final_path = self.recording_path
+        if self.spool_path is not None:
+            self.recording_path = self.spool_path / self.recording_path.name
+            self.recording_path.mkdir(parents=True, exist_ok=True)
 
-        self.writer_pipe = sp.Popen(ffmpeg_cmd, stdin=sp.PIPE)
-        self.log_file = open(out_path.with_suffix('.meta'), 'w', newline='')
-        self.log_csv = csv.writer(self.log_file)
-        self.log_csv_header_written = False
+        index = None
+        if self.segment_length or self.segment_frames:
+            index = 0
+        if self.segment_length:
+            # Same clock as the segment boundaries, the host's clock may be off from the eyes'. Shared by all Writers
+            # of the recording, so segment numbers cover the same time on all eyes.
+            self._first_segment_key = self.parent.first_segment_key(
+                math.floor(frame_time(metadata) / self.segment_length))
+            # Writers starting after a boundary passed begin with a later segment
+            index = self.segment_index(metadata)
+        self._n_segment_frames = 0
+        self.segment = self.open_segment(index)
 
         # # WARNING: REMOVE ME!
         # if self.id == 4:
         #     try:
-        #         self.writer_pipe.terminate()
+        #         self.segment.proc.terminate()
         #     except PermissionError:
         #         pass
 
-        self.recording = self.writer_pipe.poll() is None
+        self.recording = self.segment.alive()
+
+        if self.recording and self.pretrigger is not None:
+            logging.debug('Writing {} pre-trigger frames'.format(len(self.pretrigger)))
+            self.write_frames(list(self.pretrigger.drain()))
+
+    def open_segment(self, index, part=0):
+        encoder = ENCODERS[self.cfg['encoder']]
+
+        warm, self.warm = self.warm, None
+        if warm is not None and not (warm.alive() and warm.encoder is encoder and warm.low_bitrate == self.low_bitrate):
+            logging.warning('Warm encoder of {} unusable, starting a new one'.format(self.name))
+            warm.discard()
+            warm = None
+
+        segment = Segment(self.id, self.recording_path, self.recording_ts, encoder=encoder,
+                          meta_log=METADATA_LOGS[self.cfg['metadata_format']], index=index, part=part,
+                          warm=warm, low_bitrate=self.low_bitrate, mover=self.mover,
+                          final_path=self.final_path)
+
+        if self.cfg['warm_encoders']:
+            self.replenish()
+        return segment
+
+    def replenish(self):
+        """Start an encoder for the next segment in the background.
+        """
+        if self.warm is not None or (self._warmer is not None and self._warmer.is_alive()):
+            return
+        self._warmer = threading.Thread(target=self._spawn_warm, name='Warm #{:02d}'.format(self.id), daemon=True)
+        self._warmer.start()
+
+    def _spawn_warm(self):
+        try:
+            warm_path = (self.spool_path or self.cfg['out_path']) / WARM_DIR
+            warm_path.mkdir(exist_ok=True)
+            self.warm = WarmEncoder(ENCODERS[self.cfg['encoder']], warm_path, prefix='eye{:02d}'.format(self.id + 1),
+                                    low_bitrate=self.low_bitrate)
+        except OSError as e:
+            logging.error('Failed to start warm encoder for {}: {}'.format(self.name, e))
+
+    def discard_warm(self):
+        # An encoder still being started would be left running
+        if self._warmer is not None:
+            self._warmer.join()
+        if self.warm is not None:
+            self.warm.discard()
+            self.warm = None
+
+    def segment_index(self, metadata, n_pending=0):
+        """Index of the segment a frame belongs to, with `n_pending` frames before it not written yet.
+
+        Pre-trigger frames go into the first segment.
+        """
+        if self.segment_frames:
+            return self.segment.index + (self._n_segment_frames + n_pending >= self.segment_frames)
+        return max(0, math.floor(frame_time(metadata) / self.segment_length) - self._first_segment_key)
+
+    def rollover(self, index):
+        """Continue writing into a new segment, the previous one is finished in the background.
+        """
+        previous = self.segment
+        self.segment = self.open_segment(index)
+        self._n_segment_frames = 0
+        logging.debug('Segment {} started after {} frames in {}'.format(index, previous.n_frames, previous.path.name))
+
+        self.finalize(previous)
+
+    def finalize(self, segment):
+        """Close a segment in the background.
+        """
+        self._finalizers = [finalizer for finalizer in self._finalizers if finalizer.is_alive()]
+        finalizer = threading.Thread(target=segment.close, name='Finalize #{:02d}'.format(self.id))
+        finalizer.start()
+        self._finalizers.append(finalizer)
+
+    def recover(self, error):
+        """Replace a failed encoder by a new part of the current segment.
+
+        Frames arriving in the meantime wait in the write queue.
+        """
+        failed = self.segment
+        failed.error = error
+        t_failure = time.monotonic() if failed.t_stalled is None else failed.t_stalled
+
+        self.finalize(failed)
+
+        part = failed.part
+        while self.n_restarts < ENCODER_MAX_RESTARTS:
+            self.n_restarts += 1
+            part += 1
+            logging.error('Encoder of {} failed ({}) after {} frames, continuing in part {}'.format(
+                self.name, error, failed.n_frames, part))
+            try:
+                self.segment = self.open_segment(failed.index, part=part)
+            except OSError as e:
+                error = 'failed to start: {}'.format(e)
+                continue
+            self.segment.t_failure = t_failure
+            return
+
+        logging.error('Encoder of {} failed ({}), giving up after {} restarts!'.format(
+            self.name, error, self.n_restarts))
+        self.segment = None
+        self.recording = False
+        # No more attempts to start the recording again
+        self.n_retry = NUM_PIPE_RETRIES + 1
+
+    def write_frames(self, batch):
+        """Write a batch of (metadata, frame) pairs to the encoder and the metadata log.
+        """
+        if self.segment is None:
+            logging.error('Attempted to write to failed Writer!')
+            self.recording = False
+            return
+
+        # Split the batch at segment boundaries
+        if self.segment_length or self.segment_frames:
+            start = 0
+            for n, (metadata, _) in enumerate(batch):
+                index = self.segment_index(metadata, n - start)
+                if index > self.segment.index:
+                    self._write(batch[start:n])
+                    if self.segment is None:
+                        return
+                    self.rollover(index)
+                    start = n
+            batch = batch[start:]
+
+        self._write(batch)
+
+    def _write(self, batch):
+        if not batch:
+            return
+
+        while self.recording:
+            segment = self.segment
+            if segment.alive():
+                t_blocked = segment.pipe.t_blocked
+                t0 = time.monotonic()
+                error = None
+                try:
+                    segment.write(batch)
+                except BrokenPipeError:
+                    error = 'stalled' if segment.stalled else 'pipe closed'
+                finally:
+                    self.t_blocked += segment.pipe.t_blocked - t_blocked
+
+                # Frames taken by the failed encoder are not written again
+                accepted, batch = batch[:segment.n_accepted], batch[segment.n_accepted:]
+                self.n_frames += len(accepted)
+                self._n_segment_frames += len(accepted)
+                self.n_bytes_written += sum(len(frame) for _, frame in accepted)
+                # Failed writes count too, a stalled encoder shows as the time until the watchdog killed it
+                self.write_latency.observe((time.monotonic() - t0) * 1000)
+                if error is None:
+                    return
+            else:
+                error = 'exited with code {}'.format(segment.proc.returncode)
+            self.recover(error)
+            if not batch:
+                return
 
     def stop_recording(self):
         if self.recording:
@@ -68,26 +408,22 @@ class Writer(threading.Thread):
         self.recording = False
         self._ev_recording.clear()
 
-        if self.writer_pipe is not None:
-            self.writer_pipe.stdin.close()
-            self.writer_pipe.wait()
-            self.writer_pipe = None
-
-        if self.log_file is not None and not self.log_file.closed:
-            self.log_csv = None
-            self.log_file.close()
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
 
         self.logger = None
         self.n_retry = 0
+        self.n_restarts = 0
 
     def run(self):
         logging.debug('Starting loop in {}!'.format(self.name))
+        if self.cfg['warm_encoders']:
+            self.replenish()
         try:
             while not self._ev_stop.is_set():
-                try:
-                    metadata, frame = self.in_queue.get(timeout=.5)
-
-                except Empty:
+                batch = self.in_queue.get_batch(WRITE_BATCH_SIZE, timeout=.5)
+                if not batch:
                     continue
 
                 rec = self._ev_recording.is_set()
@@ -95,35 +431,58 @@ class Writer(threading.Thread):
                     if rec and self.n_retry < NUM_PIPE_RETRIES:
                         if self.n_retry:
                             logging.warning(f'Retry {self.n_retry + 1} to start recording.')
-                        self.start_recording()
+                        self.start_recording(batch[0][0])
                         self.n_retry += 1
 
                     if rec and self.n_retry == NUM_PIPE_RETRIES:
                         logging.error('Failed to start recording, maximum number of retries exceeded!')
                         self.n_retry += 1
 
-                    if not rec and self.recording:
-                        self.stop_recording()
+                # Also resets Writers that failed or gave up on the last recording, for the next one
+                if not rec and (self.recording or self.segment is not None or self.n_retry):
+                    self.stop_recording()
 
                 if self.recording:
-                    if self.writer_pipe is None:
-                        logging.error('Attempted to write to failed Writer!')
-                        self.recording = False
-                    else:
-                        try:
-                            self.writer_pipe.stdin.write(frame)
-                        except BrokenPipeError:
-                            logging.error('FFMPEG Pipe closed unexpectedly.')
-                            self.recording = False
-                        else:
-                            if not self.log_csv_header_written:
-                                self.log_csv.writerow(metadata.keys())
-                                self.log_csv_header_written = True
-                            self.log_csv.writerow(metadata.values())
-
-            logging.debug('Stopping loop in {}!'.format(self.name))
+                    self.write_frames(batch)
+                elif self.pretrigger is not None and not rec:
+                    for metadata, frame in batch:
+                        self.pretrigger.append(metadata, frame)
+
+            logging.debug('Stopping loop in {}! Write queue {}, {:.1f}s blocked on encoders'.format(
+                self.name, self.in_queue.stats(), self.t_blocked))
         except BaseException as e:
             raise e
         finally:
-            pass
-            #self.stop_recording()
+            self.discard_warm()
+            # Close the active segment, with a spool it is handed to the mover before the mover finishes
+            self.stop_recording()
+            for finalizer in self._finalizers:
+                finalizer.join()
+
+
+class EncoderWatchdog(threading.Thread):
+    """Kills encoders of Writers that don't accept frames for ENCODER_STALL_TIMEOUT seconds.
+
+    The Writer blocked on the write then gets a BrokenPipeError and replaces the encoder. Runs until all Writers
+    have finished, so that a stalled encoder can't block shutting down.
+    """
+
+    def __init__(self, writers):
+        super().__init__(name='Watchdog', daemon=True)
+        self.writers = writers
+
+    def run(self):
+        while any(writer.is_alive() for writer in self.writers):
+            time.sleep(ENCODER_WATCHDOG_INTERVAL)
+            now = time.monotonic()
+            for writer in self.writers:
+                segment = writer.segment
+                if segment is None or segment.stalled:
+                    continue
+
+                t_write = segment.t_write
+                if t_write is not None and now - t_write > ENCODER_STALL_TIMEOUT:
+                    logging.error('Encoder of {} stalled for {:.1f}s, killing it'.format(writer.name, now - t_write))
+                    segment.stalled = True
+                    segment.t_stalled = t_write
+                    segment.proc.kill()